@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# This file compile the transfer curves of the DMX channels into lookup tables
+#   The sensors are computed as fixed point levels, each channel turn its level into a DMX value with its table
+#
+
+import math
+import numpy as np
+
+LEVEL_BITS = 12                     # 16 times the DMX resolution, so the curves keep the low levels distinct
+LEVELS = 1 << LEVEL_BITS
+LEVEL_MAX = LEVELS - 1
+
+
+def _scurve(x, k):
+    """
+    Logistic curve through (0, 0) and (1, 1)
+    :param k: steepness, higher is steeper
+    """
+    low, high = 1 / (1 + math.exp(k / 2.)), 1 / (1 + math.exp(-k / 2.))
+    return (1 / (1 + np.exp(-k * (x - 0.5))) - low) / (high - low)
+
+
+def curve(spec):
+    """
+    Return the transfer function of a curve
+    :param spec: "linear", "gamma:<exponent>", "scurve:<steepness>" or list of [level, value] points in [0, 1]
+    :return: function which map an array of levels in [0, 1] to values in [0, 1]
+    """
+    if isinstance(spec, (list, tuple)):
+        points = np.array(spec, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) < 2 or np.any(np.diff(points[:, 0]) <= 0):
+            raise ValueError("Curve points must be at least two increasing [level, value] : {0}".format(spec))
+        return lambda x: np.interp(x, points[:, 0], points[:, 1])
+    name, _, param = str(spec).partition(":")
+    if name == "linear":
+        return lambda x: x
+    if name == "gamma" and float(param) > 0:
+        return lambda x: x ** float(param)
+    if name == "scurve" and float(param) > 0:
+        return lambda x: _scurve(x, float(param))
+    raise ValueError("Unknown curve {0}".format(spec))
+
+
+def compile_curve(spec, max_value):
+    """
+    :param spec: see curve
+    :param max_value: DMX value of the level LEVEL_MAX
+    :return: uint8 array of the DMX value of each level
+    """
+    values = curve(spec)(np.arange(LEVELS) / float(LEVEL_MAX))
+    return np.floor(np.clip(values, 0, 1) * max_value + 1e-6).astype(np.uint8)
+
+
+def compile_curves(specs, max_value):
+    """
+    Compile several curves into one flat table, the curve i start at i * LEVELS
+    :param specs: list of curve specs
+    :param max_value: DMX value of the level LEVEL_MAX
+    :return: read only uint8 array
+    """
+    table = np.concatenate([compile_curve(spec, max_value) for spec in specs])
+    table.setflags(write=False)
+    return table
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# This file provide the smoothing filters of the sensors
+#   A filter smooth a group of sensors at once, its state is indexed by rows : one row for each sensor of the group
+#   The depth of a row is the number of values its output depend on
+#
+
+import numpy as np
+
+from logger import init_log
+
+log = init_log("filters")
+
+
+class Filter(object):
+    """
+    Base class of the filters
+    """
+
+    def __init__(self, n_rows):
+        """
+        :param n_rows: number of sensors smoothed
+        :return:
+        """
+        self.n_rows = n_rows
+        self.depth = np.zeros(n_rows, dtype=np.intp)
+        self.output = np.zeros(n_rows, dtype=np.float64)       # Filtered value of each row, see compute
+
+    def put(self, rows, data):
+        """
+        Add one value to several rows
+        :param rows: array of distinct rows
+        :param data: array of values
+        :return:
+        """
+        raise NotImplementedError
+
+    def set_depth(self, rows, depth):
+        """
+        Change the depth of several rows, their output doesn't jump
+        :param rows: array of rows
+        :param depth: new depth in samples
+        :return:
+        """
+        raise NotImplementedError
+
+    def compute(self):
+        """
+        Update output with the values put since the last call
+        :return:
+        """
+        pass
+
+
+class Ema(Filter):
+    """
+    Exponential moving average, alpha = 2 / (depth + 1) gives the mean delay of a boxcar of the same depth
+    Only one float of state for each row
+    """
+
+    def __init__(self, n_rows, depth, max_depth=None):
+        Filter.__init__(self, n_rows)
+        self._alpha = np.zeros(n_rows, dtype=np.float64)
+        self.set_depth(np.arange(n_rows), depth)
+
+    def set_depth(self, rows, depth):
+        self.depth[rows] = depth
+        self._alpha[rows] = 2. / (depth + 1)
+
+    def put(self, rows, data):
+        self.output[rows] += self._alpha[rows] * (data - self.output[rows])
+
+
+class WindowFilter(Filter):
+    """
+    Base class of the filters over the last depth values of each row, kept in a circular buffer per row
+    """
+
+    def __init__(self, n_rows, depth, max_depth):
+        """
+        :param max_depth: depth reachable without reallocating the buffer
+        :return:
+        """
+        Filter.__init__(self, n_rows)
+        self._buffer = np.zeros((n_rows, max(depth, max_depth)), dtype=np.int16)
+        self._head = np.zeros(n_rows, dtype=np.intp)            # Next column to overwrite in each row
+        self.set_depth(np.arange(n_rows), depth)
+
+    def set_depth(self, rows, depth):
+        """
+        The buffer of the rows is filled with their current output
+        """
+        rows = rows[self.depth[rows] != depth]
+        if len(rows) == 0:
+            return
+        if self.depth.all():                        # Output of the values put since the last compute
+            self.compute()
+        if depth > self._buffer.shape[1]:           # Deeper than max_depth, buffers must grow
+            log.info("Grow filter buffers to {0} samples", depth)
+            buffer = np.zeros((self.n_rows, depth), dtype=self._buffer.dtype)
+            buffer[:, :self._buffer.shape[1]] = self._buffer
+            self._buffer = buffer
+        self._buffer[rows, :depth] = self.output[rows, np.newaxis]
+        self._head[rows] = 0
+        self.depth[rows] = depth
+        self._refill(rows)
+
+    def _refill(self, rows):
+        """
+        Update the state derived from the buffer of the rows after they have been refilled
+        :return:
+        """
+        pass
+
+    def _replace(self, rows, head, data):
+        """
+        Called before data overwrite the values at head in the rows
+        :return:
+        """
+        pass
+
+    def put(self, rows, data):
+        head = self._head[rows]
+        self._replace(rows, head, data)
+        self._buffer[rows, head] = data
+        self._head[rows] = (head + 1) % self.depth[rows]
+
+
+class Boxcar(WindowFilter):
+    """
+    Mean of the last depth values, kept as a running sum
+    """
+
+    def __init__(self, n_rows, depth, max_depth):
+        self._sum = np.zeros(n_rows, dtype=np.int64)            # Running sum of each row
+        WindowFilter.__init__(self, n_rows, depth, max_depth)
+
+    def _refill(self, rows):
+        self._sum[rows] = self._buffer[rows, 0] * self.depth[rows]
+
+    def _replace(self, rows, head, data):
+        self._sum[rows] += data - self._buffer[rows, head]
+
+    def compute(self):
+        np.true_divide(self._sum, self.depth, out=self.output)
+
+
+class Median(WindowFilter):
+    """
+    Median of the last depth values, reject the spikes shorter than half the depth
+    Only the rows which received a value are computed again
+    """
+
+    def __init__(self, n_rows, depth, max_depth):
+        self._dirty = np.zeros(n_rows, dtype=np.bool_)
+        WindowFilter.__init__(self, n_rows, depth, max_depth)
+
+    def _refill(self, rows):
+        self._dirty[rows] = True
+
+    def _replace(self, rows, head, data):
+        self._dirty[rows] = True
+
+    def compute(self):
+        if not self._dirty.any():
+            return
+        rows = np.flatnonzero(self._dirty)
+        depths = self.depth[rows]
+        for depth in np.unique(depths):         # Usually all the rows have the same depth
+            same = rows[depths == depth]
+            self.output[same] = np.median(self._buffer[same, :depth], axis=1)
+        self._dirty.fill(False)
+
+
+FILTERS = {
+    "boxcar": Boxcar,
+    "ema": Ema,
+    "median": Median,
+}
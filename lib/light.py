@@ -3,32 +3,414 @@
 
 import threading
 import numpy as np
-import ola.ClientWrapper
+import fcntl
 import math
+import os
+import select
 import time
+import socket
+import struct
+import uuid
+try:
+    import ola.ClientWrapper
+except ImportError:     # Only needed by the OLA backend
+    ola = None
 
 
+import mtools
+import telemetry
 from settings import settings
 from logger import init_log
 
 log = init_log("dmx")
 
+UNIVERSE_SIZE = 512
+
+
+class OutputBackend(object):
+    """
+    Base class of the DMX outputs
+    """
+
+    def send(self, universe, data):
+        """
+        Send the channels of an universe
+        :param universe: DMX universe
+        :param data: numpy uint8 array of at most UNIVERSE_SIZE channels
+        :return:
+        """
+        raise NotImplementedError
+
+    def probe(self):
+        """
+        Check if the output can be used, called until it returns True before the first send
+        :return: True if ready
+        """
+        return True
+
+    def close(self):
+        pass
+
+
+class OlaBackend(OutputBackend):
+    """
+    Send DMX through olad, the RPC connection is opened by probe
+    """
+
+    def __init__(self):
+        if ola is None:
+            raise RuntimeError("OLA python module not installed")
+        self.wrapper = None
+        self.client = None
+        self._failed = False            # Last probe failed, the next failures are only logged at debug
+
+    def probe(self):
+        if self.client is not None:
+            return True
+        try:
+            self.wrapper = ola.ClientWrapper.ClientWrapper()
+        except Exception as e:          # OLADNotRunningException or socket.error, olad not listening yet
+            if self._failed:
+                log.debug("olad not ready : {0!r}", e)
+            else:
+                log.warning("olad not ready, wait for it : {0!r}", e)
+            self._failed = True
+            return False
+        self.client = self.wrapper.Client()
+        return True
+
+    def send(self, universe, data):
+        self.client.SendDmx(universe, data)
+
+
+class UdpBackend(OutputBackend):
+    """
+    Base class of the UDP outputs, each universe have its own preallocated packet updated in place
+    """
+
+    HEADER_SIZE = 0
+
+    def __init__(self, host, port):
+        """
+        :param host: destination IP, broadcast allowed
+        :param port: destination UDP port
+        :return:
+        """
+        self._host = host
+        self._port = int(port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._packets = dict()      # universe : (packet, channels view, destination)
+
+    def _header(self, universe):
+        """
+        :param universe: DMX universe
+        :return: header of the packets of this universe
+        """
+        raise NotImplementedError
+
+    def _destination(self, universe):
+        return self._host, self._port
+
+    def _sequence(self, packet):
+        """
+        Update the sequence number of the packet before sending it
+        :param packet: bytearray
+        :return:
+        """
+        pass
+
+    def _packet(self, universe):
+        """
+        Build the packet of an universe the first time it is sent
+        :param universe: DMX universe
+        :return: (packet, channels view, destination)
+        """
+        packet = bytearray(self._header(universe)) + bytearray(UNIVERSE_SIZE)
+        channels = np.frombuffer(packet, dtype=np.uint8, offset=self.HEADER_SIZE, count=UNIVERSE_SIZE)
+        self._packets[universe] = (packet, channels, self._destination(universe))
+        return self._packets[universe]
+
+    def send(self, universe, data):
+        try:
+            packet, channels, destination = self._packets[universe]
+        except KeyError:
+            packet, channels, destination = self._packet(universe)
+        channels[:len(data)] = data
+        self._sequence(packet)
+        try:
+            self._socket.sendto(packet, destination)
+        except socket.error as e:
+            log.warning("Can't send universe {0} : {1}".format(universe, e))
+
+    def close(self):
+        self._socket.close()
+
+
+class ArtNetBackend(UdpBackend):
+    """
+    Send DMX as Art-Net ArtDmx packets
+    """
+
+    HEADER_SIZE = 18
+    SEQUENCE = 12       # Index of the sequence byte
+
+    def __init__(self, host=None, port=None):
+        if host is None:
+            host = str(settings.get("dmx", "artnet", "host"))
+        if port is None:
+            port = settings.get("dmx", "artnet", "port")
+        UdpBackend.__init__(self, host, port)
+
+    def _header(self, universe):
+        # ID, OpDmx, protocol version, sequence, physical, SubUni, Net, length
+        return struct.pack("<8sH", "Art-Net", 0x5000) + \
+            struct.pack(">HBBBBH", 14, 0, 0, universe & 0xFF, universe >> 8, UNIVERSE_SIZE)
+
+    def _sequence(self, packet):
+        packet[self.SEQUENCE] = packet[self.SEQUENCE] % 255 + 1     # 0 disable sequencing
+
+
+class SacnBackend(UdpBackend):
+    """
+    Send DMX as sACN (E1.31) data packets, DMX universe 0 is the sACN universe 1
+    """
+
+    HEADER_SIZE = 126
+    SEQUENCE = 111      # Index of the sequence byte
+
+    def __init__(self, host=None, port=None, source="wsnlight", priority=100):
+        """
+        :param host: destination IP, empty to use the multicast address of each universe
+        :return:
+        """
+        if host is None:
+            host = str(settings.get("dmx", "sacn", "host"))
+        if port is None:
+            port = settings.get("dmx", "sacn", "port")
+        UdpBackend.__init__(self, host, port)
+        self._cid = uuid.uuid4().bytes
+        self._source = source
+        self._priority = priority
+
+    def _destination(self, universe):
+        if self._host != "":
+            return self._host, self._port
+        universe += 1
+        return "239.255.{0}.{1}".format(universe >> 8, universe & 0xFF), self._port
+
+    def _header(self, universe):
+        size = self.HEADER_SIZE + UNIVERSE_SIZE
+        root = struct.pack(">HH12sHI", 0x0010, 0, "ASC-E1.17", 0x7000 | (size - 16), 0x04) + self._cid
+        framing = struct.pack(">HI64sBHBBH", 0x7000 | (size - 38), 0x02, self._source, self._priority, 0, 0, 0,
+                              universe + 1)
+        dmp = struct.pack(">HBBHHHB", 0x7000 | (size - 115), 0x02, 0xA1, 0, 1, UNIVERSE_SIZE + 1, 0)
+        return root + framing + dmp
+
+    def _sequence(self, packet):
+        packet[self.SEQUENCE] = (packet[self.SEQUENCE] + 1) % 256
+
+
+class NullBackend(OutputBackend):
+    """
+    Send DMX nowhere, count the frames
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, universe, data):
+        self.sent += 1
+
+
+BACKENDS = {
+    "ola": OlaBackend,
+    "artnet": ArtNetBackend,
+    "sacn": SacnBackend,
+    "null": NullBackend,
+}
+
+
+def make_backend(name=None):
+    """
+    Create an output backend
+    :param name: key of BACKENDS, None to use the settings
+    :return: OutputBackend
+    """
+    if name is None:
+        name = str(settings.get("dmx", "backend"))
+    if name not in BACKENDS:
+        raise ValueError("Must be in {0}".format(tuple(BACKENDS.keys())))
+    log.info("Use {0} DMX output".format(name))
+    return BACKENDS[name]()
+
+
+def wait_ready(backend, must_stop, on_wait=None, first=0.05, longest=1.):
+    """
+    Probe an output until it is ready, with an exponential backoff
+    :param backend: OutputBackend
+    :param must_stop: threading.Event which abort the wait
+    :param on_wait: function called between two probes, None to only wait
+    :param first: seconds before the second probe
+    :param longest: maximum seconds between two probes
+    :return: True if ready, False if aborted
+    """
+    delay = first
+    start = mtools.monotonic()
+    while not backend.probe():
+        if on_wait is not None:
+            on_wait()
+        must_stop.wait(delay)
+        if must_stop.isSet():
+            return False
+        delay = min(delay * 2, longest)
+    log.info("Output ready after {0:.3f}s", mtools.monotonic() - start)
+    return True
+
+
+def make_wake_pipe():
+    """
+    Create the pipe used to wake up a DmxThread in event mode, its write end never blocks
+    :return: (read fd, write fd)
+    """
+    read, write = os.pipe()
+    fcntl.fcntl(write, fcntl.F_SETFL, fcntl.fcntl(write, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return read, write
+
+
+def wake_pipe(fd):
+    """
+    Wake up the DmxThread reading the pipe, can be called from any thread or process
+    :param fd: write end of the pipe
+    :return:
+    """
+    try:
+        os.write(fd, "w")
+    except OSError:         # Pipe full, the thread will wake anyway
+        pass
+
+
+def channel_index(universe, channel):
+    """
+    Return the index of a channel in the DMX array of DmxThread
+    :param universe: DMX universe, must be in the "universes" setting
+    :param channel: DMX channel, from 1 to UNIVERSE_SIZE
+    :return: int
+    """
+    universes = list(settings.get("dmx", "universes"))
+    if universe not in universes:
+        raise ValueError("Universe {0} not in {1}".format(universe, universes))
+    if not 0 < channel <= UNIVERSE_SIZE:
+        raise ValueError("Channel {0} not in [1, {1}]".format(channel, UNIVERSE_SIZE))
+    return universes.index(universe) * UNIVERSE_SIZE + channel - 1
+
+
+class FrameScheduler(object):
+    """
+    This class give a fixed cadence to the frames with absolute deadlines on a monotonic clock
+    The lateness of each frame is recorded in a fixed size histogram
+    """
+
+    SKIP = "skip"           # A missed slot is skipped, wait the next slot of the same grid
+    REALIGN = "realign"     # A missed slot is sent right away, the grid restart from now
+
+    def __init__(self, period, policy=SKIP, resolution=0.0005, bins=100):
+        """
+        :param period: time between two frames in seconds
+        :param policy: SKIP or REALIGN
+        :param resolution: width of an histogram bin in seconds
+        :param bins: number of histogram bins, later frames are counted in an extra bin
+        :return:
+        """
+        if policy not in (self.SKIP, self.REALIGN):
+            raise ValueError("Must be in {0}".format((self.SKIP, self.REALIGN)))
+        self.period = period
+        self.policy = policy
+        self.resolution = resolution
+        self.histogram = np.zeros(bins + 1, dtype=np.int64)
+        self.frames = 0         # Number of frames given
+        self.dropped = 0        # Number of slots missed
+        self.max_late = 0.      # Worst lateness in seconds
+        self._late_sum = 0.
+        self._next = None       # Deadline of the next frame
+
+    def wait(self):
+        """
+        Sleep until the deadline of the next frame
+        :return: lateness of the frame in seconds
+        """
+        now = mtools.monotonic()
+        if self._next is None:
+            self._next = now
+        late = now - self._next
+        if late >= self.period:                 # The slot is missed
+            missed = int(late / self.period)    # Slots elapsed since the deadline
+            if self.policy == self.SKIP:
+                self._next += (missed + 1) * self.period
+                missed += 1                     # The frame of the deadline isn't sent
+            else:
+                self._next = now
+            self.dropped += missed
+            log.warning("Drop {0} frame".format(missed))
+        if self._next > now:
+            time.sleep(self._next - now)
+        if self.policy == self.SKIP or late < self.period:
+            late = mtools.monotonic() - self._next
+        self._next += self.period
+        self._record(late)
+        return late
+
+    def _record(self, late):
+        """
+        Add a frame lateness to the statistics
+        :param late: seconds
+        :return:
+        """
+        self.frames += 1
+        self._late_sum += late
+        if late > self.max_late:
+            self.max_late = late
+        self.histogram[min(int(late / self.resolution), len(self.histogram) - 1)] += 1
+
+    def percentile(self, q):
+        """
+        :param q: percentage from 0 to 100
+        :return: upper bound in seconds of the lateness of q percent of the frames, None if no frame
+        """
+        if self.frames == 0:
+            return None
+        i = np.searchsorted(np.cumsum(self.histogram), q / 100. * self.frames)
+        return (i + 1) * self.resolution
+
+    def stats(self):
+        """
+        :return: dict of the lateness statistics
+        """
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "mean_late": self._late_sum / self.frames if self.frames else None,
+            "max_late": self.max_late,
+            "p50_late": self.percentile(50),
+            "p99_late": self.percentile(99),
+        }
+
 
 class DmxManager(object):
     """
 
     """
 
-    def __init__(self, universe=0, dmxoutput_size=255):
+    def __init__(self, universe=0, dmxoutput_size=UNIVERSE_SIZE):
         """
         :param universe:
         :param dmxoutput_size:
         :return:
         """
         self.universe = universe
-        self.wrapper = ola.ClientWrapper.ClientWrapper()
-        self.client = self.wrapper.Client()
-        self.client.SendDmx(self.universe, np.zeros(255, dtype=np.uint8))  # Clean all the universe
+        self.backend = make_backend()
+        wait_ready(self.backend, threading.Event())
+        self.backend.send(self.universe, np.zeros(UNIVERSE_SIZE, dtype=np.uint8))  # Clean all the universe
         self.dmxout = np.zeros(dmxoutput_size, dtype=np.uint8)
         log.info("DMX ready")
 
@@ -36,59 +418,212 @@ class DmxManager(object):
         """
         :return:
         """
-        log.debug("Update DMX {0}".format(self.dmxout[:len(settings.get("sensor", "addr"))]))
-        self.client.SendDmx(self.universe, self.dmxout)
+        if log.debug_enabled:
+            log.debug("Update DMX {0}", self.dmxout[:settings.snapshot.n_sensors])
+        self.backend.send(self.universe, self.dmxout)
 
     def close(self):
-        self.client.SendDmx(self.universe, np.zeros(255, dtype=np.uint8))  # Clean all the universe
+        self.backend.send(self.universe, np.zeros(UNIVERSE_SIZE, dtype=np.uint8))  # Clean all the universe
+        self.backend.close()
 
 
 class DmxThread(threading.Thread):
     """
     This class represent the DMX thread
+    All the universes are rows of one array, only the universes changed since their last sending are sent
     """
 
-    def __init__(self, universe=0, dmxoutput_size=255):
+    def __init__(self, universes=None, wake_fds=None):
         """
-        :param lightfile: reference to the lightfile object
-        :param universe: DMX universe to use
-        :param dmxoutput_size: Output size of the dmx array, reduce to a bit performance improving
+        :param universes: list of DMX universes to use, None to use the settings
+        :param wake_fds: (read fd, write fd) of make_wake_pipe, to be woken up by another process, None to create it
         :return:
         """
         threading.Thread.__init__(self)
         self._must_close = threading.Event()
         self._must_close.clear()
-        self.universe = universe
-        self.wrapper = ola.ClientWrapper.ClientWrapper()
-        self.client = self.wrapper.Client()
-        self.client.SendDmx(self.universe, np.zeros(255, dtype=np.uint8))  # Clean all the universe
-        self.dmxout = np.zeros(dmxoutput_size, dtype=np.uint8)
-        self.dt = 1/float(settings.get("dmx", "fps"))
+        if universes is None:
+            universes = settings.get("dmx", "universes")
+        self.universes = list(universes)
+        self.backend = make_backend()
+        self._output = np.zeros((len(self.universes), UNIVERSE_SIZE), dtype=np.uint8)
+        self._sent = np.zeros_like(self._output)                    # Last frame sent of each universe
+        self._changed = np.zeros(self._output.shape, dtype=np.bool_)
+        self._dirty = np.zeros(len(self.universes), dtype=np.bool_)
+        self._sent_at = np.zeros(len(self.universes), dtype=np.float64)
+        self._suppress = False                  # Skip frames identical to the last sent
+        self._keepalive = 0.                    # Resend unchanged universes after it
+        self.dmxout = self._output.reshape(-1)                      # Flat view, see channel_index
+        self._config = settings.snapshot
+        self.dt = self._config.dt
+        self.scheduler = FrameScheduler(self.dt, self._config.late_policy)
+        self.telemetry = telemetry.Telemetry(settings.get("telemetry", "size"), self._telemetry_channels())
+        self._dropped = 0                       # Frames dropped by the scheduler at the last frame
+        self.frames = 0                         # Frames computed since the start
+        self.sent = 0                           # Universes sent since the start
+        self.event = self._config.mode == "event"               # Send as soon as a sensor changed, see wake
+        self._min_gap = 0.
+        if wake_fds is None:
+            wake_fds = make_wake_pipe()
+        self._wake_r, self._wake_w = wake_fds                   # Wake up the thread blocked in select
         self.compute_all = None
-        self.n_sensor = len(settings.get("sensor", "addr"))
+        self.n_sensor = self._config.n_sensors
+        self._configure(self._config)
+
+    def _telemetry_channels(self):
+        """
+        Telemetry never stop the lights : a channel outside the universes is skipped with a warning
+        :return: list of index in dmxout of the channels recorded
+        """
+        indexes = []
+        for channel in settings.get("telemetry", "channels"):
+            if not isinstance(channel, (list, tuple)):          # Channel of the first universe
+                channel = (self.universes[0], channel)
+            try:
+                indexes.append(channel_index(*channel))
+            except (TypeError, ValueError) as e:
+                log.warning("Telemetry channel {0} skipped : {1}", channel, e)
+        return indexes
 
     def run(self):
         """
-        Main thread loop
+        Main thread loop, the values received while the output isn't ready are computed but not sent
         :return:
         """
-        dt = 0
-        drop = 0
+        if not wait_ready(self.backend, self._must_close, self._drain):
+            self.backend.close()        # Closed before the output was ready, nothing to clean
+            self._close_pipes()
+            return
+        self._clean()
         log.info("DMX ready")
+        if self.event:
+            self._run_event()
+        else:
+            self._run_fixed()
+        self._on_close()                        # Close on exit
+
+    def _run_fixed(self):
+        """
+        Fixed frame rate loop
+        :return:
+        """
         while self._must_close.isSet() is not True:
-            if self.dt > (dt - drop):             # If we must wait before next frame
-                time.sleep(self.dt - dt + drop)
-                drop = 0
-            else:                               # If we are in late
-                log.warning("Drop frame")
-                drop = (- self.dt + dt)*2       # Add a drop time to avoid sleep
-            t = time.time()
+            self.scheduler.wait()               # Wait the deadline of the frame
             if self.compute_all is not None:    # Protection against uninitialized thread
-                self.compute_all()              # Compute all DMX chan
-                self.client.SendDmx(self.universe, self.dmxout)     # Send DMX numpy array to olad
-                log.debug("DMX : {0}".format(self.dmxout[:self.n_sensor]))
-            dt = time.time()-t                  # Save compute time
-        self._on_close()                        # Close on exit
+                self._frame(True)
+                if log.debug_enabled:
+                    log.debug("DMX : {0}", self.dmxout[:self.n_sensor])
+
+    def _run_event(self):
+        """
+        Event driven loop : a frame is sent when woken up, at most every min_gap seconds
+        The frames of the fixed frame rate are still sent to advance auto-fall
+        :return:
+        """
+        next_tick = mtools.monotonic() + self.dt
+        last_frame = 0
+        while self._must_close.isSet() is not True:
+            now = mtools.monotonic()
+            if now < next_tick and len(select.select([self._wake_r], [], [], next_tick - now)[0]) > 0:
+                os.read(self._wake_r, 4096)     # Several wakes before the frame are merged
+                now = mtools.monotonic()
+                if now < last_frame + self._min_gap:
+                    time.sleep(last_frame + self._min_gap - now)
+                    now = mtools.monotonic()
+            tick = now >= next_tick
+            if tick:
+                next_tick = max(next_tick + self.dt, now)
+            if self.compute_all is not None:
+                self._frame(tick)
+            last_frame = now
+
+    def _drain(self):
+        """
+        Keep the sensor state up to date while the output isn't ready
+        :return:
+        """
+        if self.compute_all is not None:
+            self.compute_all(False)
+
+    def _configure(self, config):
+        """
+        Apply a settings snapshot, the mode can't be changed without restarting
+        :param config: settings.Snapshot
+        :return:
+        """
+        self._config = config
+        self.dt = config.dt
+        self.scheduler.period = config.dt
+        self.scheduler.policy = config.late_policy
+        self._suppress = config.suppress
+        self._keepalive = config.keepalive
+        self._min_gap = config.min_gap
+
+    def _frame(self, tick):
+        """
+        Compute and send a frame, record it in the telemetry
+        :param tick: False if the frame is out of the fixed frame rate
+        :return:
+        """
+        if settings.snapshot is not self._config:      # Settings reloaded since the last frame
+            self._configure(settings.snapshot)
+        start = mtools.monotonic()
+        frames = self.compute_all(tick)         # Compute all DMX chan
+        computed = mtools.monotonic()
+        self._send_dirty()                      # Send DMX numpy array to the output
+        dropped = self.scheduler.dropped
+        self.telemetry.record(start, computed - start, mtools.monotonic() - computed, frames or 0,
+                              dropped - self._dropped, self.dmxout)
+        self._dropped = dropped
+        self.frames += 1
+
+    def metrics(self):
+        """
+        :return: list of (name, type, help, labels, value) for the metrics exporter
+        """
+        return [
+            ("wsnlight_dmx_frames_total", "counter", "DMX frames computed", None, self.frames),
+            ("wsnlight_dmx_frames_dropped_total", "counter", "DMX frame slots missed", None, self.scheduler.dropped),
+            ("wsnlight_dmx_universes_sent_total", "counter", "DMX universes sent", None, self.sent),
+            ("wsnlight_dmx_max_late_seconds", "gauge", "Worst DMX frame lateness", None, self.scheduler.max_late),
+        ]
+
+    def wake(self):
+        """
+        Ask the thread to send a frame as soon as possible, for the event mode
+        Can be called from any thread
+        :return:
+        """
+        wake_pipe(self._wake_w)
+
+    def _send_dirty(self):
+        """
+        Send the universes which changed since their last sending, or not sent since keepalive
+        All the universes are sent if the suppression is disabled
+        :return:
+        """
+        now = mtools.monotonic()
+        if self._suppress:
+            np.not_equal(self._output, self._sent, out=self._changed)
+            self._changed.any(axis=1, out=self._dirty)
+            np.logical_or(self._dirty, self._sent_at <= now - self._keepalive, out=self._dirty)
+        else:
+            self._dirty.fill(True)
+        for i in np.flatnonzero(self._dirty):
+            self.backend.send(self.universes[i], self._output[i])
+            self._sent[i] = self._output[i]
+            self._sent_at[i] = now
+            self.sent += 1
+
+    def _clean(self):
+        """
+        Send a black frame to all the universes
+        :return:
+        """
+        self._sent.fill(0)
+        self._sent_at.fill(mtools.monotonic())
+        for i in range(len(self.universes)):
+            self.backend.send(self.universes[i], self._sent[i])
 
     def close(self):
         """
@@ -105,4 +640,10 @@ class DmxThread(threading.Thread):
         self.compute_all = compute_all
 
     def _on_close(self):
-        self.client.SendDmx(self.universe, np.zeros(255, dtype=np.uint8))  # Clean all the universe
\ No newline at end of file
+        self._clean()                   # Clean all the universes
+        self.backend.close()
+        self._close_pipes()
+
+    def _close_pipes(self):
+        os.close(self._wake_r)
+        os.close(self._wake_w)
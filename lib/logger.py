@@ -25,6 +25,10 @@ Usage:
 
 import os
 import sys
+import threading
+import time
+import atexit
+import collections
 import traceback
 
 import logging
@@ -71,6 +75,7 @@ if not DEFAULT_LOG_TYPE:
 # settings.write()
 
 MAX_FUNC_NAME = 20  # Max func name length
+DEFAULT_QUEUE_SIZE = 4096  # Size of the queue of the file handlers, 0 to write synchronously, see log/queue setting
 
 if not os.path.exists(LOG_PATH):
     open(LOG_PATH, "a").close()
@@ -84,6 +89,12 @@ DEFAULT_FORMAT = "%(asctime)s\t%(levelname)-9s%(name)-10s%(funcName)s%(message)s
 ALL_FORMAT = "%(asctime)s\t%(levelname)-9s%(name)-10s%(fnamelineo)-40s%(message)s"
 
 TRICK_LOG = logging.Logger("/!\\TRICK_LOG see log.py/!\\")
+FUNC_NAME_FORMAT = "{:<" + str(MAX_FUNC_NAME) + "}"
+FRAME_FIELDS = ("%(fnamelineo)", "%(funcName)", "%(lineno)", "%(filename)", "%(pathname)", "%(module)")
+if sys.version_info[0] < 3:
+    UNKNOWN_CALLER = ("(unknown file)", 0, "(unknown function)")
+else:
+    UNKNOWN_CALLER = ("(unknown file)", 0, "(unknown function)", None)
 
 
 def makeRecord(name, lvl, fn, lno, msg, args, exc_info, func=None, extra=None):
@@ -92,11 +103,23 @@ def makeRecord(name, lvl, fn, lno, msg, args, exc_info, func=None, extra=None):
     flineo = f.f_lineno
     funcname = f.f_code.co_name
     return logging.Logger.makeRecord(TRICK_LOG, name, lvl, fname, flineo, msg, args, exc_info,
-                                     str("{:<" + str(MAX_FUNC_NAME) + "}").format("[" + funcname + "]"),
+                                     FUNC_NAME_FORMAT.format("[" + funcname + "]"),
                                      extra={"fnamelineo": os.path.basename(fname) + ":" + str(
                                          flineo) + " [" + funcname + "]"})
 
 
+def makeRecordNoFrame(name, lvl, fn, lno, msg, args, exc_info, func=None, extra=None):
+    return logging.Logger.makeRecord(TRICK_LOG, name, lvl, fn, lno, msg, args, exc_info, func,
+                                     extra={"fnamelineo": ""})
+
+
+def findCaller(*args, **kwargs):
+    """
+    Replace logging.Logger.findCaller which walk the whole stack, makeRecord find the caller itself when needed
+    """
+    return UNKNOWN_CALLER
+
+
 class BaseLog:
     """
     Provides a wrapper around the logging module to simplify some logging tasks.
@@ -110,8 +133,10 @@ class BaseLog:
         self.logger = logging.getLogger(logger)
         self.level = level
         self.logger.setLevel(LEVELS[level])
-        self.logger.makeRecord = makeRecord
+        self.logger.makeRecord = makeRecordNoFrame     # Until a handler format need the caller
+        self.logger.findCaller = findCaller
         self.handler = None
+        self._update_guards()
         # self.debug("Start log system with "+level.upper()+" level")
 
     def __call__(self, *args, **kwargs):
@@ -146,6 +171,16 @@ class BaseLog:
 
         self.level = level
         self.logger.setLevel(LEVELS[level])
+        self._update_guards()
+
+    def _update_guards(self):
+        """
+        Cache for each level if it is enabled, as <level>_enabled attributes (ex: log.raw_enabled)
+        Check them before building an expensive message
+        :return:
+        """
+        for name, lvl in LEVELS.items():
+            setattr(self, name + "_enabled", self.logger.isEnabledFor(lvl))
 
     def isEnabledFor(self, lvl):
         """
@@ -156,86 +191,90 @@ class BaseLog:
 
         return self.logger.isEnabledFor(lvl)
 
-    def log(self, lvl, msg):
+    def log(self, lvl, msg, *args):
         """
         Emit a custom lvl message
         :param lvl: type(str) name of the lvl
-        :param msg: type(str) msg to log
+        :param msg: type(str) msg to log, formatted with args only if lvl is enabled
         :return:
         """
         try:
-            self.logger.log(LEVELS[lvl], msg)
+            if self.logger.isEnabledFor(LEVELS[lvl]):
+                self.logger.log(LEVELS[lvl], msg.format(*args) if args else msg)
         except KeyError:
             self.debug("Level name " + str(lvl) + " unknown. Message : " + str(msg))
 
-    def debug(self, msg=""):
+    def debug(self, msg="", *args):
         """
         Pass a debug level log message (Numeric value: 10)
 
         @type   msg: string
-        @param  msg: The message to pass
+        @param  msg: The message to pass, formatted with args only if the level is enabled
 
         """
 
-        self.logger.debug(msg)
+        if self.debug_enabled:
+            self.logger.debug(msg.format(*args) if args else msg)
 
-    def raw(self, msg=""):
+    def raw(self, msg="", *args):
         """
-        Pass an info level log message (Numeric value: 20)
+        Pass a raw level log message (Numeric value: 7)
 
         @type   msg: string
-        @param  msg: The message to pass
+        @param  msg: The message to pass, formatted with args only if the level is enabled
 
         """
 
-        try:
-            self.logger.log(LEVELS['raw'], msg)
-        except KeyError:
-            self.debug("Level name " + 'raw' + " unknown. Message : " + str(msg))
+        if self.raw_enabled:
+            self.logger.log(LEVELS['raw'], msg.format(*args) if args else msg)
 
-    def info(self, msg=""):
+    def info(self, msg="", *args):
         """
         Pass an info level log message (Numeric value: 20)
 
         @type   msg: string
-        @param  msg: The message to pass
+        @param  msg: The message to pass, formatted with args only if the level is enabled
 
         """
 
-        self.logger.info(msg)
+        if self.info_enabled:
+            self.logger.info(msg.format(*args) if args else msg)
 
-    def warning(self, msg=""):
+    def warning(self, msg="", *args):
         """
         Pass a warning level log message (Numeric value: 30)
 
         @type   msg: string
-        @param  msg: The message to pass
+        @param  msg: The message to pass, formatted with args only if the level is enabled
 
         """
 
-        self.logger.warning(msg)
+        if self.warning_enabled:
+            self.logger.warning(msg.format(*args) if args else msg)
 
-    def error(self, msg=""):
+    def error(self, msg="", *args):
         """
         Pass an error level log message (Numeric value: 40)
 
         @type   msg: string
-        @param  msg: The message to pass
+        @param  msg: The message to pass, formatted with args only if the level is enabled
 
         """
 
-        self.logger.error(msg)
+        if self.error_enabled:
+            self.logger.error(msg.format(*args) if args else msg)
 
-    def critical(self, msg=""):
+    def critical(self, msg="", *args):
         """
         Pass a critical level log message (Numeric value: 50)
 
         @type   msg: string
-        @param  msg: The message to pass
+        @param  msg: The message to pass, formatted with args only if the level is enabled
 
         """
 
-        self.logger.critical(msg)
+        if self.critical_enabled:
+            self.logger.critical(msg.format(*args) if args else msg)
 
     def exception(self, msg=""):
         """
@@ -274,6 +313,9 @@ class BaseLog:
         self.handler.setLevel(LEVELS[self.level])
         self.handler.setFormatter(logging.Formatter(format))
         self.logger.addHandler(self.handler)
+        if not isinstance(handler, NullHandler) and any(field in format for field in FRAME_FIELDS):
+            # Look for the caller only if it is printed
+            self.logger.makeRecord = makeRecord
 
 
 class ConsoleLog(BaseLog):
@@ -314,7 +356,7 @@ class FileLog(BaseLog):
 
     """
 
-    def __init__(self, logger="", level=None, format=DEFAULT_FORMAT, log_path=LOG_PATH):
+    def __init__(self, logger="", level=None, format=DEFAULT_FORMAT, log_path=LOG_PATH, queue_size=DEFAULT_QUEUE_SIZE):
         """
         @type   logger: string
         @param  logger: A keyword describing the source of the log messages
@@ -322,11 +364,14 @@ class FileLog(BaseLog):
         @type   level: string
         @param  level: The minimum level to log.  (debug, info, warning, error, critical)
 
+        @type   queue_size: int
+        @param  queue_size: Records waiting for the writer thread, 0 to write from the logging thread
+
         """
 
         BaseLog.__init__(self, logger, level)
         self.set_handler(
-            logging.handlers.TimedRotatingFileHandler(log_path, "D", 1, 7, "utf-8"),
+            file_handler(log_path, queue_size),
             ALL_FORMAT
         )
 
@@ -344,7 +389,8 @@ class DualLog(BaseLog):
 
     """
 
-    def __init__(self, logger="", level=None, format=DEFAULT_FORMAT, format_file=None, log_path=LOG_PATH):
+    def __init__(self, logger="", level=None, format=DEFAULT_FORMAT, format_file=None, log_path=LOG_PATH,
+                 queue_size=DEFAULT_QUEUE_SIZE):
         """
         @type   logger: string
         @param  logger: A keyword describing the source of the log messages
@@ -352,18 +398,174 @@ class DualLog(BaseLog):
         @type   level: string
         @param  level: The minimum level to log.  (debug, info, warning, error, critical)
 
+        @type   queue_size: int
+        @param  queue_size: Records waiting for the writer thread, 0 to write from the logging thread
+
         """
 
         BaseLog.__init__(self, logger, level)
         if format_file is None:
             format_file = format
         self.set_handler(
-            logging.handlers.TimedRotatingFileHandler(log_path, "D", 1, 7, "utf-8"),
+            file_handler(log_path, queue_size),
             format_file
         )
         self.set_handler(logging.StreamHandler(), format)
 
 
+class QueueWriter(object):
+    """
+    Thread which write the records of all the QueueHandler in batches
+    The queue is bounded, the oldest records are dropped when it is full
+    A forked child doesn't inherit the running thread, it starts its own on its first record
+
+    """
+
+    def __init__(self, size, interval=0.2):
+        """
+        @type   size: int
+        @param  size: Maximum number of records waiting
+
+        @type   interval: float
+        @param  interval: Seconds between two batches
+
+        """
+
+        self.dropped = 0
+        self._size = size
+        self._interval = interval
+        self._queue = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._pid = None            # Process running the thread
+
+    def start(self):
+        """
+        Start the thread of the current process
+
+        """
+
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self.run, name="log-writer")
+        thread.daemon = True
+        thread.start()
+
+    def _check_fork(self):
+        """
+        Start the thread again in a forked child, the records queued by the parent are left to it
+
+        """
+
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()       # May have been held by a thread of the parent
+            self._queue = collections.deque(maxlen=self._size)
+            self.start()
+
+    def put(self, handler, record):
+        """
+        Queue a record, called by the logging threads
+
+        @type   handler: logging.Handler
+        @param  handler: Handler which will write the record
+
+        """
+
+        self._check_fork()
+        with self._lock:
+            if len(self._queue) == self._size:
+                self.dropped += 1
+            self._queue.append((handler, record))
+
+    def flush(self):
+        """
+        Write all the waiting records
+
+        """
+
+        self._check_fork()
+        with self._lock:
+            batch = self._queue
+            self._queue = collections.deque(maxlen=self._size)
+        handlers = set()
+        for handler, record in batch:
+            handler.handle(record)
+            handlers.add(handler)
+        for handler in handlers:
+            handler.flush()
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            self.flush()
+
+
+WRITER = None
+
+
+def get_writer(size):
+    """
+    Return the writer thread shared by all the QueueHandler, start it on the first call
+
+    @type   size: int
+    @param  size: Size of the queue if the writer is created
+
+    """
+
+    global WRITER
+    if WRITER is None:
+        WRITER = QueueWriter(size)
+        WRITER.start()
+        atexit.register(WRITER.flush)
+    return WRITER
+
+
+def flush():
+    """
+    Write the records waiting for the writer thread, for the processes which exit without the atexit handlers
+
+    """
+
+    if WRITER is not None:
+        WRITER.flush()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handles log messages by giving them to the writer thread, the wrapped handler write them
+
+    """
+
+    def __init__(self, target, size):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.writer = get_writer(size)
+
+    def setLevel(self, level):
+        logging.Handler.setLevel(self, level)
+        self.target.setLevel(level)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        self.writer.put(self.target, record)
+
+
+def file_handler(log_path, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Return the handler of the log file, rotated every day
+
+    @type   queue_size: int
+    @param  queue_size: Records waiting for the writer thread, 0 to write from the logging thread
+
+    """
+
+    handler = logging.handlers.TimedRotatingFileHandler(log_path, "D", 1, 7, "utf-8")
+    if queue_size > 0:
+        handler = QueueHandler(handler, queue_size)
+    return handler
+
+
 class NullHandler(logging.Handler):
     """
     Handles log messages and doesn't do anything with them
@@ -412,7 +614,8 @@ def set_log_type(set_type, path=None):
         LOG_PATH = path
 
 
-def _init_log(log_name, log_lvl=None, log_type=None, log_format=None, log_format_file=None, log_path=None):
+def _init_log(log_name, log_lvl=None, log_type=None, log_format=None, log_format_file=None, log_path=None,
+              log_queue=None):
     Log = None
     if log_lvl is None:
         log_lvl = DEFAULT_LEVEL
@@ -424,14 +627,17 @@ def _init_log(log_name, log_lvl=None, log_type=None, log_format=None, log_format
         log_format_file = ALL_FORMAT
     if log_path is None:
         log_path = LOG_PATH
+    if log_queue is None:
+        log_queue = DEFAULT_QUEUE_SIZE
     if log_type not in ("Console", "File", "Both", "Null"):
         raise ValueError("Must be in {0}".format(("Console", "File", "Both", "Null")))
     if log_type == "File":
-        Log = FileLog(log_name, level=log_lvl, format=log_format, log_path=log_path)
+        Log = FileLog(log_name, level=log_lvl, format=log_format, log_path=log_path, queue_size=log_queue)
     elif log_type == "Console":
         Log = ConsoleLog(log_name, level=log_lvl, format=log_format)
     elif log_type == "Both":
-        Log = DualLog(log_name, level=log_lvl, format=log_format, format_file=log_format_file, log_path=log_path)
+        Log = DualLog(log_name, level=log_lvl, format=log_format, format_file=log_format_file, log_path=log_path,
+                      queue_size=log_queue)
     elif log_type == "Null":
         Log = NullLog(log_name, level=log_lvl)
     Log.debug("=== START LOGGING ===")
@@ -439,7 +645,7 @@ def _init_log(log_name, log_lvl=None, log_type=None, log_format=None, log_format
 
 
 def init_log(log_name, settings=None, log_lvl=None, log_type=None, log_format=DEFAULT_FORMAT,
-             log_format_file=ALL_FORMAT, log_path=None):
+             log_format_file=ALL_FORMAT, log_path=None, log_queue=None):
     if settings is None:
         settings = SETTINGS
     else:
@@ -456,6 +662,8 @@ def init_log(log_name, settings=None, log_lvl=None, log_type=None, log_format=DE
             log_format = settings["log"]["format"]
         if log_format_file is None and "format_file" in settings["log"].keys():
             log_format_file = settings["log"]["format_file"]
+        if log_queue is None and "queue" in settings["log"].keys():
+            log_queue = settings["log"]["queue"]
     else:
         raise RuntimeWarning("logger settings not init")
-    return _init_log(log_name, log_lvl, log_type, log_format, log_format_file, log_path)
\ No newline at end of file
+    return _init_log(log_name, log_lvl, log_type, log_format, log_format_file, log_path, log_queue)
\ No newline at end of file
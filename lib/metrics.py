@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file provide a local HTTP endpoint exposing the pipeline health in Prometheus text format
+#   Each source object have a metrics() method returning (name, type, help, labels, value) tuples,
+#   they are only read when the endpoint is scraped
+#
+
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import logger
+
+log = logger.init_log("metrics")
+
+
+def format_value(value):
+    """
+    :param value: number
+    :return: string of the value in Prometheus text format
+    """
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def render(sources):
+    """
+    Build the Prometheus text of all the sources
+    :param sources: list of objects with a metrics() method
+    :return: string
+    """
+    families = dict()       # name : (type, help, samples)
+    order = []
+    for source in sources:
+        for name, kind, help, labels, value in source.metrics():
+            if name not in families:
+                families[name] = (kind, help, [])
+                order.append(name)
+            families[name][2].append((labels, value))
+    if logger.WRITER is not None:
+        families["wsnlight_log_dropped_total"] = ("counter", "Log records dropped by the writer queue",
+                                                  [(None, logger.WRITER.dropped)])
+        order.append("wsnlight_log_dropped_total")
+    lines = []
+    for name in order:
+        kind, help, samples = families[name]
+        lines.append("# HELP {0} {1}".format(name, help))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        for labels, value in samples:
+            if labels:
+                label = ",".join('{0}="{1}"'.format(k, labels[k]) for k in sorted(labels))
+                lines.append("{0}{{{1}}} {2}".format(name, label, format_value(value)))
+            else:
+                lines.append("{0} {1}".format(name, format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Thread serving the metrics of the sources on http://host:port/metrics
+    """
+
+    def __init__(self, sources, host="127.0.0.1", port=9142):
+        """
+        :param sources: list of objects with a metrics() method
+        :param host: address to bind, local only by default
+        :param port: TCP port
+        :return:
+        """
+        threading.Thread.__init__(self, name="metrics")
+        self.daemon = True
+        self.sources = sources
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = render(exporter.sources)
+                except Exception as e:
+                    log.error("Can't render metrics : {0}".format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode("utf-8"))
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self._server = HTTPServer((host, port), Handler)
+        log.info("Metrics on http://{0}:{1}/metrics".format(host, port))
+
+    def run(self):
+        self._server.serve_forever()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -1,28 +1,150 @@
 # -*- coding: utf-8 -*-
 #
-# This file provide math tool as numpy circular buffer
+# This file provide the numpy rings shared between threads or processes, and the clock and process tools
 #
 
+import ctypes
+import ctypes.util
+import multiprocessing
+import time
 import numpy as np
 
 
-class CircularBuffer(object):
+try:
+    monotonic = time.monotonic
+except AttributeError:      # Python 2 : read CLOCK_MONOTONIC through the libc
+    class _Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+                                     use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    except (OSError, AttributeError):
+        _clock_gettime = None
+
+    def monotonic():
+        """
+        Return the value in seconds of a clock which can't go backward
+        :return: float
+        """
+        if _clock_gettime is None:
+            return time.time()
+        t = _Timespec()
+        _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+
+_PR_SET_PDEATHSIG = 1
+
+
+def set_parent_death_signal(signum):
     """
-    This class provide a fast circular buffer
+    Ask Linux to send a signal to this process when its parent exits, even killed by SIGKILL
+    :param signum: signal number
+    :return: False if not supported
     """
+    try:
+        prctl = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).prctl
+    except (OSError, AttributeError):
+        return False
+    return prctl(_PR_SET_PDEATHSIG, signum, 0, 0, 0) == 0
+
 
-    def __init__(self, size, dtype=np.int16):
+class SpscRing(object):
+    """
+    This class provide a preallocated ring of (slot, value, timestamp) records shared by one producer thread and one
+    consumer thread without lock : the producer only write _write, the consumer only write _read
+    """
+
+    def __init__(self, size):
         """
-        :param size: Size of the buffer
+        :param size: Maximum number of records waiting in the ring
         :return:
         """
-        self.data = np.zeros(size, dtype=dtype)
+        self.size = int(size)
+        self.slot = np.zeros(self.size, dtype=np.int32)
+        self.value = np.zeros(self.size, dtype=np.int64)
+        self.stamp = np.zeros(self.size, dtype=np.float64)
+        self.dropped = 0        # Number of records lost because the ring was full
+        self._write = 0         # Number of records pushed, only changed by the producer
+        self._read = 0          # Number of records drained, only changed by the consumer
 
-    def put(self, elem):
+    def push(self, slot, value, stamp):
+        """
+        Add a record, called by the producer
+        :param slot:
+        :param value:
+        :param stamp:
+        :return: False if the ring is full and the record dropped
         """
-        Put an elem in the buffer
-        :param elem:
+        w = self._write
+        if w - self._read >= self.size:
+            self.dropped += 1
+            return False
+        i = w % self.size
+        self.slot[i] = slot
+        self.value[i] = value
+        self.stamp[i] = stamp
+        self._write = w + 1     # Publish the record once it is complete
+        return True
+
+    def drain(self, slot, value, stamp):
+        """
+        Copy all the waiting records in the given arrays, called by the consumer
+        :param slot: array of at least size elements
+        :param value: array of at least size elements
+        :param stamp: array of at least size elements
+        :return: number of records copied
+        """
+        r = self._read
+        n = self._write - r
+        if n == 0:
+            return 0
+        start = r % self.size
+        first = min(n, self.size - start)       # Records before the end of the ring
+        slot[:first] = self.slot[start:start + first]
+        value[:first] = self.value[start:start + first]
+        stamp[:first] = self.stamp[start:start + first]
+        if first < n:
+            slot[first:n] = self.slot[:n - first]
+            value[first:n] = self.value[:n - first]
+            stamp[first:n] = self.stamp[:n - first]
+        self._read = r + n      # Release the records to the producer
+        return n
+
+
+class SharedSpscRing(SpscRing):
+    """
+    This class provide a SpscRing in shared memory, the producer and the consumer can be two processes forked after
+    its creation. The counters are kept in shared memory too so a restarted process continue where the previous
+    one stopped
+    """
+
+    def __init__(self, size):
+        """
+        :param size: Maximum number of records waiting in the ring
         :return:
         """
-        self.data = np.roll(self.data, 1)
-        self.data[0] = elem
\ No newline at end of file
+        self.size = int(size)
+        self.slot = self._shared(np.int32, self.size)
+        self.value = self._shared(np.int64, self.size)
+        self.stamp = self._shared(np.float64, self.size)
+        self._counters = self._shared(np.int64, 3)     # write, read, dropped
+
+    @staticmethod
+    def _shared(dtype, size):
+        """
+        :return: numpy array of zeros in shared memory
+        """
+        raw = multiprocessing.RawArray(ctypes.c_char, int(size) * np.dtype(dtype).itemsize)
+        return np.frombuffer(raw, dtype=dtype)
+
+    def _get_counter(i):
+        return property(lambda self: int(self._counters[i]), lambda self, value: self._counters.__setitem__(i, value))
+
+    _write = _get_counter(0)
+    _read = _get_counter(1)
+    dropped = _get_counter(2)
+    del _get_counter
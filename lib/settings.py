@@ -10,6 +10,8 @@ import json
 # Import log #
 # sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
 import logger
+import curves
+import filters
 
 #
 log = logger.init_log("setting", settings={"log": dict()}, log_type="Console")
@@ -20,6 +22,7 @@ _DEFAULT_SETTING = dict()
 _DEFAULT_SETTING["log"] = dict()
 _DEFAULT_SETTING["log"]["level"] = "info"
 _DEFAULT_SETTING["log"]["output"] = "Console"
+_DEFAULT_SETTING["log"]["queue"] = 4096             # records waiting for the file writer thread, 0 to write directly
 
 _DEFAULT_SETTING["xbee"] = dict()
 _DEFAULT_SETTING["xbee"]["baudrates"] = (
@@ -37,21 +40,60 @@ _DEFAULT_SETTING["xbee"]["ATBD"] = "3"
 _DEFAULT_SETTING["xbee"]["ATCH"] = "0C"
 _DEFAULT_SETTING["xbee"]["ATID"] = "1111"
 _DEFAULT_SETTING["xbee"]["ATMY"] = "3210"
+_DEFAULT_SETTING["xbee"]["ATAP"] = "2"
+_DEFAULT_SETTING["xbee"]["ATGT"] = "64"            # guard time of "+++" in ms, hexadecimal : 100 ms
+_DEFAULT_SETTING["xbee"]["mode"] = "transparent"   # transparent or api
+_DEFAULT_SETTING["xbee"]["capture"] = ""            # file where serial traffic is recorded, empty to disable
+_DEFAULT_SETTING["xbee"]["replay"] = ""             # capture file to replay instead of the serial port
+_DEFAULT_SETTING["xbee"]["replay_speed"] = 1.0      # 0 to replay as fast as possible
+_DEFAULT_SETTING["xbee"]["coordinators"] = ()       # dicts overriding the keys above for each radio, empty for one
 
 _DEFAULT_SETTING["reconfig_addr"] = "15"
 
 _DEFAULT_SETTING["sensor"] = dict()
 _DEFAULT_SETTING["sensor"]["depth"] = 1             # in sec
+_DEFAULT_SETTING["sensor"]["max_depth"] = 4         # in sec, depth reachable without reallocating the buffers
 _DEFAULT_SETTING["sensor"]["addr"] = (19, 20)
 _DEFAULT_SETTING["sensor"]["max_value"] = 1024
 _DEFAULT_SETTING["sensor"]["min_value"] = 80
 _DEFAULT_SETTING["sensor"]["auto_fall"] = 0.5       # in sec
+_DEFAULT_SETTING["sensor"]["filter"] = "boxcar"     # smoothing over depth : boxcar, ema or median
+_DEFAULT_SETTING["sensor"]["filters"] = dict()      # addr : filter of the sensors not using the default one
+_DEFAULT_SETTING["sensor"]["channels"] = dict()    # addr : [universe, channel] or list of them, default to the
+#                                                    first universe channels not mapped, in order,
+#                                                    ex: {"19": [[0, 1], [0, 2], [0, 3]]}
+_DEFAULT_SETTING["sensor"]["event_threshold"] = 4  # raw value change which wake the DMX thread in event mode
+_DEFAULT_SETTING["sensor"]["handoff_size"] = 1024   # max values waiting between two DMX frames
 
 _DEFAULT_SETTING["dmx"] = dict()
 _DEFAULT_SETTING["dmx"]["max_value"] = 255
 _DEFAULT_SETTING["dmx"]["fps"] = 25
+_DEFAULT_SETTING["dmx"]["mode"] = "fixed"          # fixed frame rate, or event to send as soon as a sensor changed
+_DEFAULT_SETTING["dmx"]["min_gap"] = 0.005          # in sec, minimum time between two frames in event mode
+_DEFAULT_SETTING["dmx"]["late_policy"] = "skip"    # skip a missed frame slot, or realign to send it right away
+_DEFAULT_SETTING["dmx"]["universes"] = (0,)
+_DEFAULT_SETTING["dmx"]["suppress"] = True          # do not resend a universe which didn't change
+_DEFAULT_SETTING["dmx"]["keepalive"] = 1.0          # in sec, resend unchanged universes so receivers don't time out
+_DEFAULT_SETTING["dmx"]["curve"] = "linear"         # linear, gamma:<exponent>, scurve:<steepness> or [[level, value]]
+_DEFAULT_SETTING["dmx"]["curves"] = dict()          # "universe:channel" : curve of the channels not using the default
+_DEFAULT_SETTING["dmx"]["backend"] = "ola"         # ola, artnet, sacn or null
+_DEFAULT_SETTING["dmx"]["artnet"] = dict()
+_DEFAULT_SETTING["dmx"]["artnet"]["host"] = "255.255.255.255"
+_DEFAULT_SETTING["dmx"]["artnet"]["port"] = 6454
+_DEFAULT_SETTING["dmx"]["sacn"] = dict()
+_DEFAULT_SETTING["dmx"]["sacn"]["host"] = ""       # empty to use the multicast address of the universe
+_DEFAULT_SETTING["dmx"]["sacn"]["port"] = 5568
 
+_DEFAULT_SETTING["telemetry"] = dict()
+_DEFAULT_SETTING["telemetry"]["size"] = 15000      # frames kept, 10 minutes at 25 fps
+_DEFAULT_SETTING["telemetry"]["channels"] = (1, 2, 3, 4)    # recorded, channel of the first universe or [universe, channel]
+_DEFAULT_SETTING["telemetry"]["path"] = "/tmp/wsnlight-telemetry.npy"     # dump file, see SIGUSR1
 
+_DEFAULT_SETTING["metrics"] = dict()
+_DEFAULT_SETTING["metrics"]["host"] = "127.0.0.1"
+_DEFAULT_SETTING["metrics"]["port"] = 9142           # 0 to disable the exporter, port + 1 for the ingest process
+
+_DEFAULT_SETTING["multiprocess"] = False              # Xbee ingest and DMX output in two supervised processes
 
 
 class Settings(dict):
@@ -87,6 +129,55 @@ class Settings(dict):
                         log.error("Could not create defauflt setting file, skip")
             except json.scanner.JSONDecodeError as e:
                 log.error("Could not load settings : {0}".format(e))
+        self._mtime = self._read_mtime()
+        self.snapshot = None
+        self.compile()
+
+    def _read_mtime(self):
+        """
+        :return: modification time of the settings file, None if there is no file
+        """
+        try:
+            return os.stat(self._path).st_mtime
+        except OSError:
+            return None
+
+    def compile(self):
+        """
+        Build the snapshot of the current settings, must be called after changing them
+        :return: the new Snapshot
+        """
+        self.snapshot = Snapshot(self)
+        return self.snapshot
+
+    def modified(self):
+        """
+        :return: True if the settings file changed since it was read
+        """
+        return self._read_mtime() != self._mtime
+
+    def reload(self):
+        """
+        Read again the settings file and swap the snapshot, nothing change if the new settings are invalid
+        The hot paths see the new snapshot at their next frame
+        :return: True if the new settings are used
+        """
+        if self._path == "":
+            return False
+        try:
+            with open(self._path, 'r') as fp:      # Check it first, a half written file must not reset to default
+                json.load(fp)
+            fresh = Settings(self._path, self._default)
+        except (IOError, ValueError, TypeError, KeyError) as e:
+            log.error("Invalid settings, keep the current ones : {0}".format(e))
+            self._mtime = self._read_mtime()    # Do not retry before the next change
+            return False
+        self._mtime = fresh._mtime
+        dict.clear(self)
+        dict.update(self, fresh)
+        self.snapshot = fresh.snapshot     # Atomic swap
+        log.info("Settings reloaded")
+        return True
 
     def save(self):
         return self._save(self._path, "w")
@@ -141,7 +232,98 @@ class Settings(dict):
             abs_path = os.path.join(abs_path, settings.get("path", "relative", path))
         return abs_path
 
-#settings = Settings("", _DEFAULT_SETTING)
+
+class Snapshot(object):
+    """
+    This class is an immutable, validated and typed copy of the settings used at runtime
+    Derived values are precomputed, hot paths only read attributes
+    """
+
+    __slots__ = ("fps", "dt", "depth_samples", "max_depth_samples", "sensor_min", "sensor_max", "dmx_max", "factor",
+                 "auto_fall_threshold", "addr", "n_sensors", "reconfig_addr", "event_threshold", "handoff_size",
+                 "mode", "min_gap", "late_policy", "suppress", "keepalive", "curve_table", "curves",
+                 "filter", "filters")
+
+    def __init__(self, settings):
+        """
+        :param settings: Settings object
+        :return:
+        """
+        fps = int(settings.get("dmx", "fps"))
+        sensor_min = int(settings.get("sensor", "min_value"))
+        sensor_max = int(settings.get("sensor", "max_value"))
+        dmx_max = int(settings.get("dmx", "max_value"))
+        depth_samples = int(float(settings.get("sensor", "depth")) * fps)
+        auto_fall = float(settings.get("sensor", "auto_fall"))
+        if fps <= 0:
+            raise ValueError("dmx fps must be positive")
+        if depth_samples < 1:
+            raise ValueError("sensor depth must be at least one frame")
+        if sensor_max <= sensor_min:
+            raise ValueError("sensor max_value must be greater than min_value")
+        if not 0 < dmx_max <= 255:
+            raise ValueError("dmx max_value must be in [1, 255]")
+        if auto_fall < 0:
+            raise ValueError("sensor auto_fall must be positive")
+        values = {
+            "fps": fps,
+            "dt": 1 / float(fps),
+            "depth_samples": depth_samples,
+            "max_depth_samples": max(depth_samples, int(float(settings.get("sensor", "max_depth")) * fps)),
+            "sensor_min": sensor_min,
+            "sensor_max": sensor_max,
+            "dmx_max": dmx_max,
+            "factor": float(dmx_max) / (sensor_max - sensor_min),
+            "auto_fall_threshold": fps * auto_fall,
+            "addr": tuple(int(addr) for addr in settings.get("sensor", "addr")),
+            "n_sensors": len(settings.get("sensor", "addr")),
+            "reconfig_addr": str(settings.get("reconfig_addr")),
+            "event_threshold": int(settings.get("sensor", "event_threshold")),
+            "handoff_size": int(settings.get("sensor", "handoff_size")),
+            "mode": str(settings.get("dmx", "mode")),
+            "min_gap": float(settings.get("dmx", "min_gap")),
+            "late_policy": str(settings.get("dmx", "late_policy")),
+            "suppress": bool(settings.get("dmx", "suppress")),
+            "keepalive": float(settings.get("dmx", "keepalive")),
+        }
+        values["curve_table"], values["curves"] = self._compile_curves(settings, dmx_max)
+        values["filter"] = str(settings.get("sensor", "filter"))
+        values["filters"] = dict((int(addr), str(name)) for addr, name in settings.get("sensor", "filters").items())
+        for name in [values["filter"]] + list(values["filters"].values()):
+            if name not in filters.FILTERS:
+                raise ValueError("sensor filter must be in {0}".format(tuple(filters.FILTERS.keys())))
+        if values["mode"] not in ("fixed", "event"):
+            raise ValueError("dmx mode must be in {0}".format(("fixed", "event")))
+        if values["late_policy"] not in ("skip", "realign"):
+            raise ValueError("dmx late_policy must be in {0}".format(("skip", "realign")))
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    @staticmethod
+    def _compile_curves(settings, dmx_max):
+        """
+        :return: (flat table of all the curves, dict of the curve number of each DMX array index, 0 by default)
+        """
+        universes = list(settings.get("dmx", "universes"))
+        specs = [settings.get("dmx", "curve")]
+        numbers = {json.dumps(specs[0]): 0}
+        channels = dict()
+        for key, spec in settings.get("dmx", "curves").items():
+            universe, channel = [int(i) for i in str(key).split(":")]
+            if universe not in universes or not 0 < channel <= 512:
+                raise ValueError("dmx curves : no channel {0}".format(key))
+            number = numbers.setdefault(json.dumps(spec), len(specs))
+            if number == len(specs):
+                specs.append(spec)
+            channels[universes.index(universe) * 512 + channel - 1] = number
+        return curves.compile_curves(specs, dmx_max), channels
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings snapshot is immutable")
+
+    def __repr__(self):
+        return "Snapshot({0})".format(", ".join("{0}={1}".format(k, getattr(self, k)) for k in self.__slots__))
+
 
 def init(settings_path=None, default_settings=None):
     """
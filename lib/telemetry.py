@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# This file provide a fixed size binary record of the DMX frames
+#   Cheap enough to stay on in production, dumped to a .npy file on request
+#
+
+import numpy as np
+
+from logger import init_log
+
+log = init_log("telemetry")
+
+
+class Telemetry(object):
+    """
+    This class keep one record per DMX frame in a preallocated structured ring
+    """
+
+    def __init__(self, size, channels):
+        """
+        :param size: number of frames kept
+        :param channels: index in the DMX array of the channels recorded with each frame
+        :return:
+        """
+        self.dtype = np.dtype([
+            ("stamp", np.float64),          # Monotonic time of the frame start
+            ("compute", np.float32),        # Duration of compute_all in seconds
+            ("send", np.float32),           # Duration of the sending in seconds
+            ("frames", np.uint32),          # Sensor values ingested since the last frame
+            ("drops", np.uint32),           # Frames dropped since the last frame
+            ("channels", np.uint8, (len(channels),)),
+        ])
+        self.size = int(size)
+        self.records = 0            # Number of records since the start
+        self._ring = np.zeros(self.size, dtype=self.dtype)
+        self._stamp = self._ring["stamp"]       # Field views, written without building a record
+        self._compute = self._ring["compute"]
+        self._send = self._ring["send"]
+        self._frames = self._ring["frames"]
+        self._drops = self._ring["drops"]
+        self._channels = self._ring["channels"]
+        self._index = np.array(channels, dtype=np.intp)
+
+    def record(self, stamp, compute, send, frames, drops, dmxout):
+        """
+        Record a frame, overwrite the oldest one
+        :param stamp: monotonic time of the frame start
+        :param compute: duration of compute_all in seconds
+        :param send: duration of the sending in seconds
+        :param frames: sensor values ingested since the last frame
+        :param drops: frames dropped since the last frame
+        :param dmxout: DMX array
+        :return:
+        """
+        i = self.records % self.size
+        self._stamp[i] = stamp
+        self._compute[i] = compute
+        self._send[i] = send
+        self._frames[i] = frames
+        self._drops[i] = drops
+        np.take(dmxout, self._index, out=self._channels[i])
+        self.records += 1
+
+    def snapshot(self):
+        """
+        :return: copy of the records, oldest first
+        """
+        start = self.records % self.size
+        if self.records <= self.size:
+            return self._ring[:start].copy()
+        return np.concatenate((self._ring[start:], self._ring[:start]))
+
+    def dump(self, path):
+        """
+        Write the records, oldest first, in a memory mapped .npy file (read it with numpy.load)
+        :param path: path of the file, overwritten if exists
+        :return: number of records written
+        """
+        records = self.snapshot()
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=records.shape)
+        out[:] = records
+        out.flush()
+        del out
+        log.info("Dump {0} telemetry records to {1}".format(len(records), path))
+        return len(records)
@@ -1,27 +1,57 @@
 # -*- coding: utf-8 -*-
 #
 
+import collections
 import serial
+import struct
 import threading
 import time
 import numpy as np
 
+import curves
+import filters
 import mtools
+import light
 
 from settings import settings
 import logger
 
 log = logger.init_log("wsn")
 
+CAPTURE_RECORD = struct.Struct("<dI")   # Seconds since the capture start, length of the chunk which follows
+
+DEFAULT_GUARD_TIME = 1.   # GT of a module not configured yet, it answers "+++" only after this silence
+COMMAND_TIMEOUT = 1.    # Seconds to wait for the response of a command
+COMMAND_RETRIES = 3
+
+# Over the air commands sent from reconfig_addr, ex: "G19:1.5;D*:0.5"
+#   <op><addr>:<value> where addr is a sensor address or * for all the sensors
+COMMAND_SEPARATOR = ";"
+COMMAND_ALL = "*"
+COMMAND_OPS = {
+    "G": "gain",        # Multiply the output of the sensor
+    "M": "min",         # Raw value which gives a null output
+    "D": "depth",       # Smoothing depth in seconds
+    "F": "auto_fall",   # Seconds without value before auto-fall
+    "E": "enable",      # 0 to ignore the sensor and black out its channel, 1 to enable it again
+}
+COMMAND_RING_SIZE = 64  # Commands waiting for the next frame
+
+ADDR_SPACE = 0x10000    # 16-bit Xbee addresses
+
 
 class Xbee(object):
     """
     This class represent the Xbee module
     """
 
-    def __init__(self, serial_path=None, ATMY=None, ATID=None, ATCH=None, ATBD=None):
+    def __init__(self, serial_path=None, ATMY=None, ATID=None, ATCH=None, ATBD=None, port=None, capture_path=None,
+                 ATGT=None):
         """
         This method initiate the Xbee object but not the Xbee
+        :param port: object to use instead of opening serial_path, ex: a ReplaySerial
+        :param capture_path: file where every chunk read is recorded, None to use the settings
+        :param ATGT: guard time of the escape sequence in ms, hexadecimal
         :return:
         """
         self._lock_serial = threading.Lock()
@@ -35,80 +65,125 @@ class Xbee(object):
             ATID = str(settings.get("xbee", "ATID"))
         if ATMY is None:
             ATMY = str(settings.get("xbee", "ATMY"))
-        self._serial = serial.Serial(serial_path, settings.get("xbee", "baudrates")[int(ATBD)], timeout=1)
+        if ATGT is None:
+            ATGT = str(settings.get("xbee", "ATGT"))
+        if capture_path is None:
+            capture_path = str(settings.get("xbee", "capture"))
+        if port is None:
+            port = serial.Serial(serial_path, settings.get("xbee", "baudrates")[int(ATBD)], timeout=1)
+        self.name = serial_path     # Label of the metrics
+        self._serial = port
+        self._capture = None
+        if capture_path != "":
+            self._capture = SerialCapture(capture_path)
         self._conf = {
             "ATMY": ATMY,
             "ATID": ATID,
             "ATCH": ATCH,
-            "ATBD": ATBD
+            "ATBD": ATBD,
+            "ATAP": "0",        # Transparent, a module left in API mode by a previous run is set back
+            "ATGT": ATGT
         }
         self._have_been_init = False
-        self._conf_mode = False
+        self._parser = FrameParser()
+        self._frames = collections.deque()
+        self.bytes_read = 0         # Serial bytes read since the start
 
     def close(self):
         """
-        Ask to close the Xbee module
+        Ask to close the Xbee module, its configuration is kept for the next start
         :return:
         """
-        if not self._conf_send("ATRE\r"):
-            log.warning("Can't reset Xbee config before closing")
         self._serial.close()
+        if self._capture is not None:
+            self._capture.close()
         log.debug("Xbee serial close")
 
-    def _conf_send(self, cmd, check=True, retry=True):
+    def _read_response(self, n_lines, timeout):
         """
-        This methode send a command to the XBee and wait for a OK\r
-        :param cmd: command to send
-        :param check: True if wait a OK response
-        :param retry: True if auto retry to send the command if failled
-        :return:
+        Read the response lines of a command
+        :param n_lines: number of lines expected
+        :param timeout: seconds to wait for all the lines
+        :return: list of lines without the \r, None if timeout reached
+        """
+        lines = []
+        line = ""
+        deadline = mtools.monotonic() + timeout
+        while mtools.monotonic() < deadline:
+            b = self._serial.read(1)
+            if b == "\r":
+                lines.append(line)
+                line = ""
+                if len(lines) == n_lines:
+                    return lines
+            else:
+                line += b
+        log.warning("Xbee response timeout, got {0!r}".format(lines + [line]))
+        return None
+
+    def _command(self, cmd, n_lines=1, timeout=COMMAND_TIMEOUT):
+        """
+        This methode send a command line to the Xbee and read its response
+        :param cmd: command to send, several AT commands can be batched : "ATMY,ID\r"
+        :param n_lines: number of lines expected, one for each batched command
+        :param timeout: seconds to wait for the response
+        :return: list of response lines, None if timeout reached
         """
-        if cmd != "+++" and not self._conf_mode:
-            log.debug("need to be in conf mode, goto")
-            while not self._conf_send("+++"):
-                time.sleep(1.1)
-        elif cmd == "CN\r":
-            self._conf_mode = False
         with self._lock_serial:
-            log.debug("send : {0}, conf {1}".format(cmd, self._conf_mode))
+            log.debug("send : {0!r}", cmd)
             self._serial.write(cmd)
-            b = 0
-            r = ''
-            if check is False:
-                return True
-            while b != '\r' and b != '\n':
-                b = ""
-                while len(b) == 0:  # Ignore timeout
-                    b = self._serial.read(1)
-                r = r + b
-            if r[-3:] != "OK\r":
-                log.warning("!!! XBEE NOT OK !!! : {0}".format(str(r)))
-                self._conf_mode = False
-                if not retry:
-                    return False
-            elif cmd == "+++":
-                self._conf_mode = True
-                time.sleep(1.1)
-                return True
-            else:
+            return self._read_response(n_lines, timeout)
+
+    def _enter_command_mode(self):
+        """
+        Send the escape sequence, the module answer after its guard time so no sleep is needed
+        The configured guard time is written with the other values, a module which still has the default one
+        is waited by the retries
+        :return: True if the module is in command mode
+        """
+        guard_time = int(self._conf["ATGT"], 16) / 1000.
+        for attempt in range(COMMAND_RETRIES):
+            if attempt > 0:
+                guard_time = max(guard_time, DEFAULT_GUARD_TIME)
+            response = self._command("+++", timeout=guard_time + COMMAND_TIMEOUT)
+            if response is not None and response[-1].endswith("OK"):
                 return True
-        return self._conf_send(cmd, check, retry)
+            log.warning("Xbee didn't enter command mode, attempt {0}", attempt + 1)
+        return False
 
     def init(self):
         """
-        This methode send the current configuration to the Xbee
-        :return:
+        This methode read back the configuration of the Xbee and only write the values which differ
+        :return: True if the Xbee is configured
         """
-        succes = True
-        for key, value in self._conf.items():
-            if not self._conf_send(key + str(value) + "\r"):
-                succes = False
+        if not self._enter_command_mode():
+            log.warning("XBEE: !FAIL INIT!")
+            return False
+        keys = sorted(self._conf.keys())
+        current = None
+        for attempt in range(COMMAND_RETRIES):
+            current = self._command("AT" + ",".join(key[2:] for key in keys) + "\r", len(keys))
+            if current is not None:
                 break
-        if succes:
-            if self._conf_send("CN" + "\r", check=False):
-                log.info("XBEE: INIT OK")
-                self._have_been_init = True
-                return True
+        try:
+            diff = [key for key, value in zip(keys, current) if int(value, 16) != int(self._conf[key], 16)]
+        except (TypeError, ValueError):
+            log.warning("Can't read back Xbee config {0!r}, write all".format(current))
+            diff = keys
+        success = True
+        if len(diff) > 0:
+            log.info("XBEE: write {0}", ", ".join(key + self._conf[key] for key in diff))
+            for attempt in range(COMMAND_RETRIES):
+                response = self._command("AT" + ",".join(key[2:] + str(self._conf[key]) for key in diff) + ",WR\r",
+                                         len(diff) + 1)
+                success = response is not None and all(line == "OK" for line in response)
+                if success:
+                    break
+        self._command("ATCN\r")
+        if success:
+            log.info("XBEE: INIT OK")
+            self._have_been_init = True
+            return True
         log.warning("XBEE: !FAIL INIT!")
         return False
 
@@ -117,67 +192,636 @@ class Xbee(object):
         This method wait a frame and return it
         :return: False if timeout reached
         """
+        if len(self._frames) == 0:
+            self._frames.extend(self.get_frames())
+            if len(self._frames) == 0:
+                return False
+        return self._frames.popleft()
+
+    def get_frames(self):
+        """
+        This method read all the bytes waiting on the serial port and return every complete frame found
+        :return: list of frames, empty if timeout reached
+        """
         with self._lock_serial:
-            inframe = False
-            frame = ""
-            while True:
-                r = self._serial.read(1)
-                if len(r) == 0:  # Timeout occured
-                    return False
-                if inframe:
-                    if r == "/":
-                        log.warning("Frame conflict")
-                        inframe = False
-                    elif r == "\\":
-                        return SensorFrame(frame)
-                    else:
-                        frame += r
+            chunk = self._serial.read(self._serial.in_waiting or 1)     # Block for at least one byte
+        if len(chunk) == 0:  # Timeout occured
+            return []
+        self.bytes_read += len(chunk)
+        if self._capture is not None:
+            self._capture.write(chunk)
+        return self._parser.feed(chunk)
+
+    def metrics(self):
+        """
+        :return: list of (name, type, help, labels, value) for the metrics exporter
+        """
+        labels = {"port": self.name}
+        return [
+            ("wsnlight_serial_bytes_total", "counter", "Serial bytes read", labels, self.bytes_read),
+            ("wsnlight_frames_parsed_total", "counter", "Valid frames parsed", labels, self._parser.frames),
+            ("wsnlight_frames_corrupted_total", "counter", "Corrupted frames skipped", labels, self._parser.corrupted),
+            ("wsnlight_frame_conflicts_total", "counter", "Frame conflict resyncs", labels, self._parser.conflicts),
+        ]
+
+
+def make_xbees(port=None):
+    """
+    Create an Xbee for each coordinator of the settings, see xbee/coordinators
+    :param port: object to use instead of the serial ports, ex: a ReplaySerial, only one Xbee is created
+    :return: list of Xbee
+    """
+    coordinators = settings.get("xbee", "coordinators")
+    if len(coordinators) == 0 or port is not None:
+        coordinators = [dict()]
+    xbees = []
+    for conf in coordinators:
+        if len(xbees) > 0 and "capture" not in conf:        # Several radios can't share a capture file
+            conf = dict(conf, capture="")
+
+        def get(key):
+            return str(conf.get(key, settings.get("xbee", key)))
+        args = (get("serial"), get("ATMY"), get("ATID"), get("ATCH"), get("ATBD"))
+        if get("mode") == "api":
+            xbees.append(XbeeApi(*args, ATAP=get("ATAP"), port=port, capture_path=get("capture"), ATGT=get("ATGT")))
+        else:
+            xbees.append(Xbee(*args, port=port, capture_path=get("capture"), ATGT=get("ATGT")))
+    return xbees
+
+
+class SerialCapture(object):
+    """
+    This class record the chunks read on the serial port with their time of arrival
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the capture file, overwritten if exists
+        :return:
+        """
+        self._fp = open(path, "wb")
+        self._start = mtools.monotonic()
+        log.info("Capture serial to {0}".format(path))
+
+    def write(self, chunk):
+        """
+        Record a chunk
+        :param chunk: string read from the serial port
+        :return:
+        """
+        self._fp.write(CAPTURE_RECORD.pack(mtools.monotonic() - self._start, len(chunk)))
+        self._fp.write(chunk)
+
+    def close(self):
+        self._fp.close()
+
+
+class ReplaySerial(object):
+    """
+    This class replay a capture file and can be used in place of serial.Serial by the Xbee class
+    """
+
+    def __init__(self, path, speed=1.0, timeout=1):
+        """
+        :param path: path of the capture file
+        :param speed: time scale of the replay, 2 replay twice faster, 0 replay as fast as possible
+        :param timeout: read timeout in seconds, as serial.Serial
+        :return:
+        """
+        self._fp = open(path, "rb")
+        self._speed = float(speed)
+        self.timeout = timeout
+        self._start = None              # Time of the first read
+        self._next = self._load()       # Next record (time, chunk) not yet available, None at the end
+        self._buffer = ""               # Bytes available but not read yet
+        log.info("Replay serial from {0} at speed {1}".format(path, speed))
+
+    def _load(self):
+        """
+        Read the next record of the capture file
+        :return: (time, chunk) or None at the end of the file
+        """
+        head = self._fp.read(CAPTURE_RECORD.size)
+        if len(head) < CAPTURE_RECORD.size:
+            return None
+        t, length = CAPTURE_RECORD.unpack(head)
+        return t, self._fp.read(length)
+
+    def _due(self, record):
+        """
+        :param record: (time, chunk)
+        :return: time at which the record must be available
+        """
+        if self._speed == 0:
+            return self._start
+        return self._start + record[0] / self._speed
+
+    def _fill(self):
+        """
+        Move the records whose time has come to the buffer
+        :return:
+        """
+        if self._start is None:
+            self._start = mtools.monotonic()
+        now = mtools.monotonic()
+        while self._next is not None and self._due(self._next) <= now:
+            self._buffer += self._next[1]
+            self._next = self._load()
+
+    @property
+    def in_waiting(self):
+        self._fill()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        """
+        Read bytes as serial.Serial.read, wait the time of the next record if needed
+        :param size: max number of bytes to read
+        :return: string, empty if timeout reached
+        """
+        self._fill()
+        if len(self._buffer) == 0:
+            if self._next is None:      # End of the capture, behave as a silent radio
+                time.sleep(self.timeout)
+                return ""
+            wait = self._due(self._next) - mtools.monotonic()
+            if wait > self.timeout:
+                time.sleep(self.timeout)
+                return ""
+            time.sleep(max(wait, 0))
+            self._fill()
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def write(self, data):
+        """
+        Commands are not send to anything
+        :param data:
+        :return: number of bytes written
+        """
+        return len(data)
+
+    def close(self):
+        self._fp.close()
+
+
+class FrameParser(object):
+    """
+    Incremental parser of the "/src,val\\" frames, partial frames are kept between two feeds
+    """
+
+    def __init__(self):
+        self._partial = ""      # Start of an uncomplete frame, always begin with "/" if not empty
+        self.frames = 0         # Counters since the start
+        self.corrupted = 0
+        self.conflicts = 0
+
+    def feed(self, chunk):
+        """
+        Parse a chunk of raw bytes
+        :param chunk: string read from the serial port
+        :return: list of complete SensorFrame
+        """
+        frames = []
+        data = self._partial + chunk
+        start = data.find("/")
+        while start >= 0:
+            end = data.find("\\", start + 1)
+            conflict = data.find("/", start + 1)
+            if conflict >= 0 and (end < 0 or conflict < end):   # A new frame start before the end of this one
+                log.warning("Frame conflict")
+                self.conflicts += 1
+                start = data.find("/", conflict + 1)            # Wait for the next frame start
+            elif end < 0:                                       # Frame continue in the next chunk
+                break
+            else:
+                frame = SensorFrame(data[start + 1:end])
+                if frame.src is not None:
+                    frames.append(frame)
                 else:
-                    if r == "/":
-                        inframe = True
-                if not inframe:
-                    frame = ""
+                    self.corrupted += 1
+                start = data.find("/", end + 1)
+        self.frames += len(frames)
+        if start < 0:
+            self._partial = ""
+        else:
+            self._partial = data[start:]
+        return frames
 
 
-class SensorManager(object):
+class XbeeApi(Xbee):
+    """
+    This class represent the Xbee module used in API mode (AP=1 or AP=2)
+    Sensors send their value as a binary big endian unsigned short, the source address and the RSSI are read in
+    the RX packet header
     """
 
+    def __init__(self, serial_path=None, ATMY=None, ATID=None, ATCH=None, ATBD=None, ATAP=None, port=None,
+                 capture_path=None, ATGT=None):
+        """
+        This method initiate the Xbee object but not the Xbee
+        :param ATAP: API mode, "1" without escaping or "2" with escaping
+        :return:
+        """
+        Xbee.__init__(self, serial_path, ATMY, ATID, ATCH, ATBD, port, capture_path, ATGT)
+        if ATAP is None:
+            ATAP = str(settings.get("xbee", "ATAP"))
+        self._conf["ATAP"] = ATAP
+        self._parser = ApiFrameParser(escaped=(int(ATAP) == 2))
+
+
+class ApiFrameParser(object):
     """
+    Incremental parser of the 0x7E delimited API packets, partial packets are kept between two feeds
+    """
+
+    START = "\x7e"
+    ESCAPE = "\x7d"
+    RX_16 = 0x81            # API identifier of a RX packet with 16-bit source address
+    MAX_LENGTH = 0x80       # Longer packet can't be send by the module, the length field is corrupted
 
-    def __init__(self, sensor_addr, dmx_output):
+    def __init__(self, escaped=True):
         """
-        :param sensor_addr: tuple of address
+        :param escaped: True if the module escape special bytes (AP=2)
         :return:
         """
-        self.sensors = dict()
-        self.n_sensors = len(sensor_addr)
-        self.dmx_output = dmx_output
-        i = 0
-        for addr in sensor_addr:
-            self.sensors[int(addr)] = SensorValues(i)
-            i += 1
+        self._escaped = escaped
+        self._partial = ""              # Raw start of an uncomplete packet, begin with START if not empty
+        self.frames = 0                 # Counters since the start
+        self.corrupted = 0
+        self.conflicts = 0              # Always 0, kept for the metrics
 
-    def compute_all(self):
+    def _unescape(self, data):
         """
-        Compute all sensors
+        Remove escaping from the bytes of one packet
+        :param data: raw bytes between two delimiters
+        :return: unescaped string
+        """
+        parts = data.split(self.ESCAPE)
+        return parts[0] + "".join(chr(ord(p[0]) ^ 0x20) + p[1:] for p in parts[1:] if len(p) > 0)
+
+    def _check(self, body):
+        """
+        Check the length and the checksum of an unescaped packet
+        :param body: bytes following START, from the length field
+        :return: frame data of the packet, "" if it isn't complete, None if it is corrupted
+        """
+        if len(body) < 3:                                       # Length not received yet
+            return ""
+        length = (ord(body[0]) << 8) | ord(body[1])
+        if length == 0 or length > self.MAX_LENGTH:
+            log.warning("Corrupted API frame length {0} : skip".format(length))
+            return None
+        if len(body) < length + 3:                              # Packet continue in the next chunk
+            return ""
+        packet = body[2:length + 2]
+        if (sum(bytearray(packet)) + ord(body[length + 2])) & 0xFF != 0xFF:
+            log.warning("Corrupted API frame checksum : skip")
+            return None
+        return packet
+
+    def feed(self, chunk):
+        """
+        Parse a chunk of raw bytes
+        :param chunk: string read from the serial port
+        :return: list of complete ApiSensorFrame
+        """
+        if self._escaped:
+            frames = self._feed_escaped(self._partial + chunk)
+        else:
+            frames = self._feed_raw(self._partial + chunk)
+        self.frames += len(frames)
+        return frames
+
+    def _feed_escaped(self, data):
+        """
+        A START in the raw bytes is always a delimiter, the packets are split on them before being unescaped
+        so an escaped 0x7E in the data can't be taken for a delimiter and a corrupted packet is skipped at once
+        """
+        frames = []
+        self._partial = ""
+        start = data.find(self.START)
+        while start >= 0:
+            end = data.find(self.START, start + 1)              # -1 if the next packet isn't received yet
+            raw = data[start + 1:] if end < 0 else data[start + 1:end]
+            if end < 0 and raw.endswith(self.ESCAPE):           # Escaped byte in the next chunk
+                packet = ""
+            else:
+                packet = self._check(self._unescape(raw))
+            if packet == "" and end < 0:
+                self._partial = data[start:]
+                break
+            if not packet:                                      # Corrupted or truncated by the next packet
+                if packet == "":
+                    log.warning("Truncated API frame : skip")
+                self.corrupted += 1
+            else:
+                frame = self._decode(packet)
+                if frame is not None:
+                    frames.append(frame)
+            start = end
+        return frames
+
+    def _feed_raw(self, data):
+        """
+        Without escaping a 0x7E may be a data byte, the parser resync on the next one after a corrupted packet
+        """
+        frames = []
+        start = data.find(self.START)
+        while start >= 0:
+            packet = self._check(data[start + 1:start + self.MAX_LENGTH + 4])
+            if packet == "":
+                break
+            if packet is None:
+                self.corrupted += 1
+                start = data.find(self.START, start + 1)
+                continue
+            frame = self._decode(packet)
+            if frame is not None:
+                frames.append(frame)
+            start = data.find(self.START, start + len(packet) + 4)
+        if start < 0:
+            self._partial = ""
+        else:
+            self._partial = data[start:]
+        return frames
+
+    def _decode(self, packet):
+        """
+        Decode the frame data of a valid packet
+        :param packet: frame data, from the API identifier to the checksum excluded
+        :return: ApiSensorFrame or None if the packet isn't a RX packet
+        """
+        if ord(packet[0]) != self.RX_16 or len(packet) < 5:
+            log.debug("Ignore API packet {0}", hex(ord(packet[0])))
+            return None
+        src = (ord(packet[1]) << 8) | ord(packet[2])
+        payload = packet[5:]
+        if len(payload) == 2:
+            val = (ord(payload[0]) << 8) | ord(payload[1])
+        else:
+            val = payload
+        return ApiSensorFrame(src, val, - ord(packet[3]), packet)
+
+
+class SensorInput(object):
+    """
+    Producer side of a SensorManager, each thread reading frames has its own
+    Its rings and counters are only written by this thread
+    """
+
+    def __init__(self, manager, handoff, commands):
+        """
+        :param manager: SensorManager consuming the rings
+        :param handoff: ring of the values, records are (slot, value, monotonic time)
+        :param commands: ring of the parsed commands, records are (op letter code, target slot or -1 for all, value)
         :return:
         """
-        for addr, sensor in self.sensors.items():
-            self.dmx_output[sensor.addr] = sensor.compute()
+        self._manager = manager
+        self.handoff = handoff
+        self.commands = commands
+        self._last_raw = np.zeros(manager.n_sensors, dtype=np.int64)   # Last value received of each sensor
+        self.unknown = 0            # Frames from addresses not configured
+        self.corrupted = 0          # Frames whose value isn't a number
+        self.bad_commands = 0       # Commands which can't be parsed
+
+    def reconfigure(self, raw):
+        """
+        Parse an over the air command and queue it for the next compute_all, see COMMAND_OPS
+        :param raw: command string, ex: "G19:1.5;E20:0"
+        :return: number of commands queued
+        """
+        queued = 0
+        for command in str(raw).split(COMMAND_SEPARATOR):
+            try:
+                target, value = command[1:].split(":")
+                if command[0] not in COMMAND_OPS:
+                    raise KeyError(command[0])
+                value = float(value)
+                if not np.isfinite(value):          # nan and inf pass the range checks of SensorBank.apply
+                    raise ValueError(value)
+                slot = -1 if target == COMMAND_ALL else self._manager.sensors[int(target)]   # Only once per command
+            except (IndexError, KeyError, ValueError):
+                log.warning("Ignore invalid command {0!r}", command)
+                self.bad_commands += 1
+                continue
+            if not self.commands.push(ord(command[0]), slot, value):
+                log.warning("Too many commands, drop {0!r}", command)
+                continue
+            queued += 1
+        return queued
 
     def recv_frame(self, frame):
         """
+        Queue the value of a frame for the next compute_all
         :param frame: frame object
-        :return:
+        :return: True if the value differ from the last one of the sensor by at least event_threshold
         """
-        if int(frame.src) not in self.sensors.keys():
-            log.warning("Ignore frame {0} because addr not configure {1}".format(frame, self.sensors.keys()))
+        try:
+            slot = self._manager.lut[int(frame.src)]
+        except (IndexError, ValueError):    # Not a 16-bit address
+            slot = -1
+        if slot < 0:
+            log.warning("Ignore frame {0} because addr not configured", frame)
+            self.unknown += 1
+            return False
+        log.raw("Add {0} in {1}", frame.val, frame.src)
+        try:
+            val = int(frame.val)
+        except ValueError:
+            log.warning("Corrupted frame value {0} : skip".format(frame))
+            self.corrupted += 1
+            return False
+        now = mtools.monotonic()
+        if not self.handoff.push(slot, val, now):
+            log.warning("Handoff full, drop frame {0}".format(frame))
             return False
-        log.raw("Add {0} in {1}".format(frame.val, frame.src))
-        sens = self.sensors[int(frame.src)]
-        # self.sensors[int(frame.src)].put_data(int(frame.val))
-        sens.put_data(int(frame.val))
-        # self.dmx_output[sens.addr] = sens.compute()
+        # Compared with the last value heard by this thread only, a sensor is usually heard by one coordinator
+        changed = abs(val - self._last_raw[slot]) >= settings.snapshot.event_threshold
+        self._last_raw[slot] = val
+        return changed
+
+
+class SensorManager(object):
+    """
+    Consumer side of the sensors : apply the values and the commands queued by the SensorInput of each producer
+    thread to the bank
+    """
+
+    def __init__(self, sensor_addr, dmx_output, handoffs=None, commands=None):
+        """
+        :param sensor_addr: tuple of 16-bit addresses
+        :param dmx_output: DMX array of DmxThread
+        :param handoffs: ring of the values of each producer thread, None to create one, see add_input
+        :param commands: ring of the parsed commands of each producer thread, None to create one
+        :return:
+        """
+        self.sensors = dict()       # Slot of each sensor address in the bank
+        self.n_sensors = len(sensor_addr)
+        self.dmx_output = dmx_output
+        self.lut = np.empty(ADDR_SPACE, dtype=np.int32)        # Slot of each address, -1 if it isn't a sensor
+        self.lut.fill(-1)
+        mapping = settings.get("sensor", "channels")
+        universe = settings.get("dmx", "universes")[0]
+        mapped = dict()             # Index in dmx_output of the channels of each sensor with a mapping
+        claimed = dict()            # Sensor address of each mapped channel
+        for i in range(self.n_sensors):
+            addr = int(sensor_addr[i])
+            if not 0 <= addr < ADDR_SPACE:
+                raise ValueError("Sensor address {0} not in [0, {1}]".format(addr, ADDR_SPACE - 1))
+            self.sensors[addr] = i
+            self.lut[addr] = i
+            if str(addr) in mapping:
+                mapped[i] = []
+                for fixture in channel_set(mapping[str(addr)]):
+                    index = light.channel_index(*fixture)
+                    if index in claimed:
+                        raise ValueError("Channel {0} mapped to sensors {1} and {2}".format(list(fixture),
+                                                                                             claimed[index], addr))
+                    claimed[index] = addr
+                    mapped[i].append(index)
+        slots = []                  # Slot and index in dmx_output of each channel driven by a sensor
+        channels = []
+        channel = 0                 # Last channel given to a sensor without mapping
+        for i in range(self.n_sensors):
+            if i not in mapped:     # The next channel of the first universe not mapped to another sensor
+                channel += 1
+                while light.channel_index(universe, channel) in claimed:
+                    channel += 1
+                mapped[i] = [light.channel_index(universe, channel)]
+            slots.extend([i] * len(mapped[i]))
+            channels.extend(mapped[i])
+        self.bank = SensorBank(self.n_sensors, dmx_output, np.array(channels, dtype=np.intp),
+                               np.array(slots, dtype=np.intp), sensor_addr)
+        if handoffs is None:
+            handoffs = [mtools.SpscRing(settings.snapshot.handoff_size)]         # SensorThread to DmxThread
+        if commands is None:
+            commands = [mtools.SpscRing(COMMAND_RING_SIZE) for handoff in handoffs]
+        self.inputs = [SensorInput(self, handoff, ring) for handoff, ring in zip(handoffs, commands)]
+        self.handoff = self.inputs[0].handoff
+        self._slots = np.zeros(self.handoff.size, dtype=np.int32)
+        self._values = np.zeros(self.handoff.size, dtype=np.int64)
+        self._stamps = np.zeros(self.handoff.size, dtype=np.float64)
+        self.last_seen = np.zeros(self.n_sensors, dtype=np.float64)   # Monotonic time of the last value applied
+        self._config = settings.snapshot
+        size = self.inputs[0].commands.size
+        self._command_records = (np.zeros(size, dtype=np.int32), np.zeros(size, dtype=np.int64),
+                                 np.zeros(size, dtype=np.float64))
+        self.commands = 0           # Commands applied
+        self.bad_commands = 0       # Commands which can't be applied
+
+    def add_input(self):
+        """
+        Create the rings of another producer thread, must be called before compute_all is used
+        :return: SensorInput
+        """
+        sensor_input = SensorInput(self, mtools.SpscRing(self.handoff.size), mtools.SpscRing(COMMAND_RING_SIZE))
+        self.inputs.append(sensor_input)
+        return sensor_input
+
+    def reconfigure(self, raw):
+        """
+        Queue an over the air command in the rings of the first producer, see SensorInput.reconfigure
+        """
+        return self.inputs[0].reconfigure(raw)
+
+    def recv_frame(self, frame):
+        """
+        Queue a frame in the rings of the first producer, see SensorInput.recv_frame
+        """
+        return self.inputs[0].recv_frame(frame)
+
+    def _apply_commands(self):
+        """
+        Apply the queued commands to the bank, in place
+        :return:
+        """
+        codes, targets, values = self._command_records
+        for sensor_input in self.inputs:
+            for i in range(sensor_input.commands.drain(codes, targets, values)):
+                op, value = COMMAND_OPS[chr(codes[i])], values[i]
+                slots = np.arange(self.n_sensors) if targets[i] < 0 else targets[i:i + 1]
+                if self.bank.apply(op, slots, value, self._config):
+                    log.info("Reconfig {0} of slots {1} to {2}", op, slots, value)
+                    self.commands += 1
+                else:
+                    log.warning("Can't set {0} of slots {1} to {2}", op, slots, value)
+                    self.bad_commands += 1
+
+    def compute_all(self, tick=True):
+        """
+        Apply the values received since the last call and compute all sensors
+        Must be called by the consumer thread of the handoff rings
+        :param tick: False if the call is out of the fixed frame rate, auto-fall is not advanced
+        :return: number of values applied
+        """
+        if settings.snapshot is not self._config:      # Settings reloaded since the last frame
+            self._config = settings.snapshot
+            self.bank.configure(self._config)
+        self._apply_commands()
+        n = 0
+        for sensor_input in self.inputs:
+            count = sensor_input.handoff.drain(self._slots, self._values, self._stamps)
+            if count > 0:
+                self._put(self._slots[:count], self._values[:count])
+                self.last_seen[self._slots[:count]] = self._stamps[:count]
+            n += count
+        self.bank.compute(tick)
+        return n
+
+    def _put(self, slots, values):
+        """
+        Put values in the bank in their order, the values of a same sensor are put in successive rounds
+        :param slots: array of sensor slots
+        :param values: array of raw values
+        :return:
+        """
+        order = np.argsort(slots, kind="mergesort")    # Stable, keep the order of the values of each sensor
+        ordered = slots[order]
+        first = np.empty(len(ordered), dtype=np.bool_)  # First value of each sensor
+        first[0] = True
+        np.not_equal(ordered[1:], ordered[:-1], out=first[1:])
+        if first.all():             # One value per sensor
+            self.bank.put(slots, values)
+            return
+        rank = np.arange(len(ordered)) - np.flatnonzero(first)[np.cumsum(first) - 1]
+        for i in range(rank.max() + 1):
+            selected = order[rank == i]
+            self.bank.put(slots[selected], values[selected])
+
+    def metrics(self):
+        """
+        :return: list of (name, type, help, labels, value) for the metrics exporter
+        """
+        now = mtools.monotonic()
+        last_seen = self.last_seen.copy()
+        falling = self.bank.falling()
+        metrics = [     # The counters of the inputs are exported by their SensorThread, in the ingest process
+            ("wsnlight_reconfig_total", "counter", "Over the air commands applied", None, self.commands),
+            ("wsnlight_reconfig_rejected_total", "counter", "Over the air commands which can't be applied", None,
+             self.bad_commands),
+        ]
+        for addr, slot in self.sensors.items():
+            labels = {"addr": addr}
+            age = now - last_seen[slot] if last_seen[slot] > 0 else float("nan")
+            metrics.append(("wsnlight_sensor_last_seen_seconds", "gauge", "Seconds since the last value of the sensor",
+                            labels, age))
+            metrics.append(("wsnlight_sensor_auto_fall", "gauge", "1 if the sensor is in auto-fall", labels,
+                            int(falling[slot])))
+            metrics.append(("wsnlight_sensor_enabled", "gauge", "0 if the sensor is disabled over the air", labels,
+                            int(self.bank.enabled[slot])))
+        return metrics
+
+
+def channel_set(mapping):
+    """
+    :param mapping: [universe, channel] or list of [universe, channel] of a sensor, see sensor/channels setting
+    :return: list of (universe, channel)
+    """
+    if len(mapping) > 0 and isinstance(mapping[0], (list, tuple)):
+        return [tuple(fixture) for fixture in mapping]
+    return [tuple(mapping)]
 
 
 class SensorThread(threading.Thread):
@@ -185,17 +829,28 @@ class SensorThread(threading.Thread):
     Class which recv sensorframes and keep a value table up to date
     """
 
-    def __init__(self, xbee, dmxout):
+    def __init__(self, xbee, dmxout, wake=None, sensors=None, sensor_input=None):
         """
-        :param n_sensor: number of sensor
+        :param xbee: Xbee object to read
+        :param dmxout: DMX array of DmxThread
+        :param wake: function called when a sensor value changed enough, None to not notify
+        :param sensors: SensorManager shared with the threads of the other coordinators, None to create it
+        :param sensor_input: SensorInput of this thread in sensors, None to create it
         :return:
         """
         threading.Thread.__init__(self)
         self._must_stop = threading.Event()
         self._must_stop.clear()
         self.xbee = xbee
-        self.sensors = SensorManager(tuple(settings.get("sensor", "addr")), dmxout)
-        self._config_addr = str(settings.get("reconfig_addr"))
+        if sensors is None:
+            sensors = SensorManager(settings.snapshot.addr, dmxout)
+            sensor_input = sensors.inputs[0]
+        elif sensor_input is None:
+            sensor_input = sensors.add_input()
+        self.sensors = sensors
+        self._input = sensor_input
+        self._config_addr = settings.snapshot.reconfig_addr
+        self._wake = wake
 
     def run(self):
         """
@@ -203,16 +858,31 @@ class SensorThread(threading.Thread):
         :return:
         """
         while self._must_stop.isSet() is not True:
-            frame = self.xbee.get_frame()
-            log.raw("get {0}".format(frame))
-            if frame is False:
-                continue
-            elif str(frame.src) == self._config_addr:
-                log.debug("Reconfig {0}".format(frame.val))
-            else:
-                self.sensors.recv_frame(frame)
+            for frame in self.xbee.get_frames():
+                log.raw("get {0}", frame)
+                if str(frame.src) == self._config_addr:
+                    log.debug("Reconfig {0}", frame.val)
+                    self._input.reconfigure(frame.val)
+                elif self._input.recv_frame(frame) and self._wake is not None:
+                    self._wake()
         self.xbee.close()
 
+    def metrics(self):
+        """
+        :return: list of (name, type, help, labels, value) for the metrics exporter
+        """
+        labels = {"port": self.xbee.name}
+        return [
+            ("wsnlight_handoff_dropped_total", "counter", "Values dropped because the handoff ring was full",
+             labels, self._input.handoff.dropped),
+            ("wsnlight_frames_unknown_addr_total", "counter", "Frames from addresses not configured", labels,
+             self._input.unknown),
+            ("wsnlight_frames_bad_value_total", "counter", "Frames whose value isn't a number", labels,
+             self._input.corrupted),
+            ("wsnlight_reconfig_invalid_total", "counter", "Over the air commands which can't be parsed", labels,
+             self._input.bad_commands),
+        ]
+
     def close(self):
         """
         Ask thread to stop
@@ -221,71 +891,233 @@ class SensorThread(threading.Thread):
         self._must_stop.set()
 
 
-class SensorValues(object):
+class SensorBank(object):
     """
-    Class which transform raw data to DMX value
+    Class which transform raw data to DMX values for all the sensors at once
+    Each sensor own a slot in each state array and a row in the filter of its group, see filters
     """
 
-    def __init__(self, addr):
+    def __init__(self, n_sensors, output, channels, slots=None, addr=None):
         """
-        :param addr: dmx_addr
+        :param n_sensors: number of sensors
+        :param output: DMX array where the value of each sensor is written
+        :param channels: array of indexes in output
+        :param slots: array of the sensor slot written in each channel, None for one channel per sensor in order
+        :param addr: address of each sensor to find its filter in the settings, None to use the default filter
         :return:
         """
-        self._sum_depth = float(settings.get("sensor", "depth")) * int(settings.get("dmx", "fps"))
-        self._buffer = mtools.CircularBuffer(self._sum_depth)
+        config = settings.snapshot
+        self.n_sensors = n_sensors
         self.addr = addr
-        self._uptodate = 0
-        self._auto_fall_threshold = float(settings.get("dmx", "fps")) * float(settings.get("sensor", "auto_fall"))
-        self._cache = 0
-        self._factor = float(settings.get("dmx", "max_value")) / (
-                       self._sum_depth * ( int(settings.get("sensor", "max_value")) - int(settings.get("sensor", "min_value")) ))
-        self.min_val = int(settings.get("sensor", "min_value"))
-
-        log.debug("facotr {0}, min_val {1} !".format(self._factor, self.min_val))
+        self.filters = []                                       # (filter, array of its sensor slots)
+        self._filter_names = None
+        self._kind = np.zeros(n_sensors, dtype=np.intp)         # Index in filters of each sensor
+        self._row = np.zeros(n_sensors, dtype=np.intp)          # Row of each sensor in its filter
+        self._max_depth = 0
+        self._mean = np.zeros(n_sensors, dtype=np.float64)      # Filtered value of each sensor
+        self._uptodate = np.zeros(n_sensors, dtype=np.int64)    # Number of compute since the last value
+        self._cache = np.zeros(n_sensors, dtype=np.int64)       # Last computed DMX value
+        self._auto_fall_threshold = np.zeros(n_sensors, dtype=np.float64)   # Computes without value before auto-fall
+        self._factor = np.zeros(n_sensors, dtype=np.float64)
+        self.gain = np.zeros(n_sensors, dtype=np.float64)
+        self.enabled = np.zeros(n_sensors, dtype=np.bool_)      # Disabled sensors output 0 and ignore their values
+        self.min_val = np.zeros(n_sensors, dtype=np.int64)
+        self.max_val = 0
+        self._sensor_max = 0
+        self.output = output
+        self.channels = channels
+        if slots is None:
+            slots = np.arange(n_sensors)
+        self._channel_slots = slots
+        self._channel_level = np.zeros(len(channels), dtype=np.intp)       # Level of each channel, index in the curves
+        self._channel_value = np.zeros(len(channels), dtype=np.uint8)
+        self._curve_offset = np.zeros(len(channels), dtype=np.intp)        # Start of the curve of each channel
+        self._curve_table = None
+        self._level = np.zeros(n_sensors, dtype=np.int64)      # Fixed point output, LEVEL_MAX is max_val
+        self._fall = np.zeros(n_sensors, dtype=np.bool_)       # Work arrays, avoid allocation on each compute
+        self._value = np.zeros(n_sensors, dtype=np.float64)
+        self.configure(config)
 
-    def put_data(self, data):
+    def configure(self, config):
         """
-        Put data in the buffer
-        :param data:
+        Apply a settings snapshot to all the sensors, must be called between two compute
+        The changes made over the air are lost
+        :param config: settings.Snapshot
         :return:
         """
-        self._uptodate = 0
-        d = data - self.min_val
-        if d < 0:
-            log.raw("Put 0 in buffer {0} (sat)".format(self.addr))
-            self._buffer.put(0)
+        slots = np.arange(self.n_sensors)
+        if self.addr is None:
+            names = [config.filter] * self.n_sensors
+        else:
+            names = [config.filters.get(int(addr), config.filter) for addr in self.addr]
+        self._max_depth = config.max_depth_samples
+        if names != self._filter_names:     # The filters state is lost
+            self._build_filters(names, config)
         else:
-            log.raw("Put {0} in buffer {1}".format(d, self.addr))
-            self._buffer.put(d)
+            self.set_depth(slots, config.depth_samples)
+        self.min_val.fill(config.sensor_min)
+        self._auto_fall_threshold.fill(config.auto_fall_threshold)
+        self.gain.fill(1.)
+        self.enabled.fill(True)
+        self.max_val = config.dmx_max
+        self._sensor_max = config.sensor_max
+        self._update_factor(slots)
+        self._curve_table = config.curve_table
+        for i in range(len(self.channels)):
+            self._curve_offset[i] = config.curves.get(self.channels[i], 0) * curves.LEVELS
+        log.debug("factor {0}, min_val {1} !", config.factor, config.sensor_min)
 
-    def _compute(self):
+    def _build_filters(self, names, config):
         """
-        :return: Value to send to the DMX channel
+        Create a filter for each group of sensors using the same one
+        :param names: filter name of each sensor, key of filters.FILTERS
+        :param config: settings.Snapshot
+        :return:
+        """
+        self._filter_names = names
+        self.filters = []
+        for name in sorted(set(names)):
+            slots = np.array([i for i in range(self.n_sensors) if names[i] == name], dtype=np.intp)
+            self._kind[slots] = len(self.filters)
+            self._row[slots] = np.arange(len(slots))
+            self.filters.append((filters.FILTERS[name](len(slots), config.depth_samples, config.max_depth_samples),
+                                 slots))
+            log.debug("Use {0} filter for slots {1}", name, slots)
+
+    def _groups(self, slots):
         """
-        v = int((np.sum(self._buffer.data[:self._sum_depth])) * float(self._factor))
-        if v < 0:
-            return 0
+        Split sensor slots by filter
+        :param slots: array of sensor slots
+        :return: list of (filter, array of rows in the filter, mask of the slots in the group or None for all)
+        """
+        if len(self.filters) == 1:
+            return [(self.filters[0][0], self._row[slots], None)]
+        groups = []
+        kinds = self._kind[slots]
+        for i in range(len(self.filters)):
+            mask = kinds == i
+            if mask.any():
+                groups.append((self.filters[i][0], self._row[slots[mask]], mask))
+        return groups
+
+    def _update_factor(self, slots):
+        """
+        Compute the factor from the filtered value to the output level
+        :param slots: array of sensor slots
+        :return:
+        """
+        self._factor[slots] = self.gain[slots] * curves.LEVEL_MAX / np.maximum(self._sensor_max - self.min_val[slots], 1)
+
+    def apply(self, op, slots, value, config):
+        """
+        Change a parameter of some sensors in place, see COMMAND_OPS
+        :param op: name of the parameter
+        :param slots: array of sensor slots
+        :param value: new value
+        :param config: settings.Snapshot to convert seconds in frames
+        :return: False if the value is out of range, the bank is unchanged
+        """
+        value = float(value)                    # A python float overflows to inf without warning
+        if not np.isfinite(value):
+            return False
+        if op == "gain":
+            if value < 0 or not np.isfinite(value * curves.LEVEL_MAX):     # An infinite factor gives nan levels
+                return False
+            self.gain[slots] = value
+        elif op == "min":
+            if not 0 <= value < self._sensor_max:
+                return False
+            self.min_val[slots] = int(value)    # Values already in the filters keep the previous offset
+        elif op == "depth":
+            if not 1 <= value * config.fps < self._max_depth + 1:    # Growing the buffers would stall the frame
+                return False
+            self.set_depth(slots, int(value * config.fps))
+        elif op == "auto_fall":
+            if not 0 <= value * config.fps < np.inf:
+                return False
+            self._auto_fall_threshold[slots] = value * config.fps
+        elif op == "enable":
+            self.enabled[slots] = value != 0
         else:
-            return v
+            return False
+        self._update_factor(slots)
+        return True
 
-    def compute(self):
+    def set_depth(self, slots, depth):
         """
-        Compute current value for the DMX channel
+        Change the number of values smoothed by some sensors, the output doesn't jump
+        :param slots: array of sensor slots
+        :param depth: new depth in samples
         :return:
         """
-        if self._uptodate > 0:      # There is no new value in the buffer
-            if self._uptodate > self._auto_fall_threshold:          # It has been too long since the last value : start auto-fall
-                self._buffer.put(int(self._cache/self._uptodate))   # Add a lower value to the buffer
-                self._cache = self._compute()                       # Compute new value
-            else:
-                log.raw("Use buffer {0}, {1}".format(self.addr,self._cache))
-            self._uptodate += 1     # Increment uptodate to know since when there haven't been a new value
-            return self._cache
-        else:                       # There at least a new value in the buffer
-            self._uptodate = 1      # Set uptodate to one to signify that the buffer and the cache are sync
-            self._cache = self._compute()
-            log.raw("Compte new value {0}, {1}".format(self.addr,self._cache))
-            return self._cache
+        for smoothing, rows, mask in self._groups(slots):
+            smoothing.set_depth(rows, depth)
+
+    def put_data(self, slot, data):
+        """
+        Put data in the filter of a sensor
+        :param slot: slot of the sensor
+        :param data: raw sensor value
+        :return:
+        """
+        self.put(np.array([slot]), np.array([data]))
+
+    def put(self, slots, data):
+        """
+        Put one value in the filter of several sensors
+        :param slots: array of distinct sensor slots
+        :param data: array of raw sensor values
+        :return:
+        """
+        enabled = self.enabled[slots]
+        if not enabled.all():
+            slots, data = slots[enabled], data[enabled]
+        self._uptodate[slots] = 0
+        self._put_many(slots, np.maximum(data - self.min_val[slots], 0))
+
+    def falling(self):
+        """
+        :return: bool array, True for the sensors in auto-fall
+        """
+        return self._uptodate > self._auto_fall_threshold
+
+    def _put_many(self, slots, data):
+        """
+        Put one value in the filter of several sensors
+        :param slots: array of distinct sensor slots
+        :param data: array of values, already shifted by min_val
+        :return:
+        """
+        for smoothing, rows, mask in self._groups(slots):
+            smoothing.put(rows, data if mask is None else data[mask])
+
+    def compute(self, tick=True):
+        """
+        Compute current value of all the DMX channels and write them in the output
+        :param tick: False if the call is out of the fixed frame rate, auto-fall is not advanced
+        :return:
+        """
+        if tick:
+            np.greater(self._uptodate, self._auto_fall_threshold, out=self._fall)
+            if self._fall.any():    # It has been too long since the last value : start auto-fall
+                slots = np.flatnonzero(self._fall)
+                self._put_many(slots, self._cache[slots] // self._uptodate[slots])     # Add a lower value to the filter
+            self._uptodate += 1     # Know since when there haven't been a new value, 1 if filter and cache are sync
+        else:
+            np.maximum(self._uptodate, 1, out=self._uptodate)      # Only sync the sensors with a new value
+        for smoothing, slots in self.filters:
+            smoothing.compute()
+            self._mean[slots] = smoothing.output
+        np.multiply(self._mean, self._factor, out=self._value)
+        np.multiply(self._value, self.enabled, out=self._value)
+        np.clip(self._value, 0, curves.LEVEL_MAX, out=self._value)
+        self._level[:] = self._value
+        np.multiply(self._level, self.max_val, out=self._cache)       # Linear DMX value for auto-fall
+        self._cache //= curves.LEVEL_MAX
+        np.take(self._level, self._channel_slots, out=self._channel_level)     # Fan out to the channels
+        self._channel_level += self._curve_offset
+        np.take(self._curve_table, self._channel_level, out=self._channel_value)
+        self.output[self.channels] = self._channel_value
 
 
 class SensorFrame(object):
@@ -303,9 +1135,33 @@ class SensorFrame(object):
             self.src, self.val = raw_frame.split(",")
         except ValueError:
             log.warning("Corrupted frame : skip")
+            self.src, self.val = None, None
+        self.rssi = None
 
     def __repr__(self):
         return "addr:{0}, val:{1}, raw:{2}".format(self.src, self.val, self._raw)
 
     def __str__(self):
         return self.__repr__()
+
+
+class ApiSensorFrame(SensorFrame):
+    """
+    This class represent a frame recv by the coordinator in API mode
+    """
+
+    def __init__(self, src, val, rssi, raw_frame):
+        """
+        :param src: 16-bit source address
+        :param val: sensor value, or raw payload string if the payload isn't a binary value
+        :param rssi: received signal strength in dBm
+        :param raw_frame: string of the frame data
+        :return:
+        """
+        self._raw = raw_frame
+        self.src = src
+        self.val = val
+        self.rssi = rssi
+
+    def __repr__(self):
+        return "addr:{0}, val:{1}, rssi:{2}dBm".format(self.src, self.val, self.rssi)
@@ -0,0 +1,258 @@
+#!/bin/python2.7
+# -*- coding: utf-8 -*-
+#
+# This file benchmark the whole pipeline without Xbee nor olad
+#   Results are printed as JSON to compare them between changes and between boards
+#
+# Usage: ./bench.py --sensors 8,64,512 --depth 1,4 --output result.json
+#
+
+import argparse
+import json
+import platform
+import sys
+import time
+import types
+
+import numpy as np
+
+from code.lib import settings
+from code.lib import logger
+
+
+class FakeClient(object):
+    """
+    Stand-in for the OLA client which record when each universe is sent
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def SendDmx(self, universe, data, callback=None):
+        self.sent.append((mtools.monotonic(), universe))
+        return True
+
+
+class FakeClientWrapper(object):
+    """
+    Stand-in for ola.ClientWrapper.ClientWrapper
+    """
+
+    def __init__(self):
+        self._client = FakeClient()
+
+    def Client(self):
+        return self._client
+
+
+class MemorySerial(object):
+    """
+    Stand-in for serial.Serial which serve an in memory byte stream in loop
+    """
+
+    def __init__(self, data, rate=0, timeout=1):
+        """
+        :param data: bytes to serve
+        :param rate: bytes per second made available, 0 for everything at once
+        :param timeout: read timeout in seconds
+        :return:
+        """
+        self._data = data
+        self._rate = float(rate)
+        self.timeout = timeout
+        self._pos = 0           # Total number of bytes read
+        self._start = mtools.monotonic()
+
+    @property
+    def in_waiting(self):
+        if self._rate == 0:
+            return len(self._data)
+        return int((mtools.monotonic() - self._start) * self._rate) - self._pos
+
+    def read(self, size=1):
+        if self._rate != 0 and self.in_waiting <= 0:
+            time.sleep(max(min((self._pos + 1) / self._rate + self._start - mtools.monotonic(), self.timeout), 0))
+            if self.in_waiting <= 0:
+                return ""
+        size = min(size, max(self.in_waiting, 1))
+        start = self._pos % len(self._data)
+        chunk = self._data[start:start + size]
+        if len(chunk) < size:
+            chunk += self._data[:size - len(chunk)]
+        self._pos += size
+        return chunk
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def install_fake_ola():
+    """
+    Make "import ola.ClientWrapper" return the stand-in
+    :return:
+    """
+    ola = types.ModuleType("ola")
+    ola.ClientWrapper = types.ModuleType("ola.ClientWrapper")
+    ola.ClientWrapper.ClientWrapper = FakeClientWrapper
+    sys.modules["ola"] = ola
+    sys.modules["ola.ClientWrapper"] = ola.ClientWrapper
+
+
+def configure(n_sensors, depth):
+    """
+    Change the settings used by the next created objects
+    :param n_sensors: number of sensors, addresses start at 1 and skip the reconfiguration address
+    :param depth: sensor depth in seconds
+    :return: tuple of sensor addresses
+    """
+    reconfig_addr = int(settings.settings.snapshot.reconfig_addr)
+    addr = tuple([a for a in range(1, n_sensors + 2) if a != reconfig_addr][:n_sensors])
+    sensor = dict(settings.settings.get("sensor"))
+    sensor["addr"] = addr
+    sensor["depth"] = depth
+    settings.settings["sensor"] = sensor
+    settings.settings.compile()
+    return addr
+
+
+def make_stream(addr, n_frames):
+    """
+    :param addr: sensor addresses
+    :param n_frames: number of frames in the stream
+    :return: string of ASCII frames with random values
+    """
+    values = np.random.randint(0, 1024, n_frames)
+    return "".join("/{0},{1}\\".format(addr[i % len(addr)], values[i]) for i in range(n_frames))
+
+
+def bench_parse(addr, n_frames):
+    """
+    :return: frames parsed per second by Xbee.get_frames
+    """
+    xbee = wsn.Xbee(port=MemorySerial(make_stream(addr, n_frames)), capture_path="")
+    n = 0
+    t = mtools.monotonic()
+    while n < n_frames:
+        n += len(xbee.get_frames())
+    return n / (mtools.monotonic() - t)
+
+
+def bench_recv(addr, n_frames):
+    """
+    :return: frames handled per second by SensorManager.recv_frame
+    """
+    manager = wsn.SensorManager(addr, np.zeros(512, dtype=np.uint8))
+    frames = wsn.FrameParser().feed(make_stream(addr, n_frames))
+    size = manager.handoff.size
+    records = (np.zeros(size, dtype=np.int32), np.zeros(size, dtype=np.int64), np.zeros(size))
+    t = mtools.monotonic()
+    for i in range(len(frames)):
+        manager.recv_frame(frames[i])
+        if i % size == size - 1:        # Empty the handoff ring as the DMX thread would
+            manager.handoff.drain(*records)
+    return len(frames) / (mtools.monotonic() - t)
+
+
+def bench_compute(addr, n_compute):
+    """
+    :return: mean duration of SensorManager.compute_all in micro seconds
+    """
+    manager = wsn.SensorManager(addr, np.zeros(512, dtype=np.uint8))
+    frames = wsn.FrameParser().feed(make_stream(addr, len(addr)))
+    duration = 0
+    for i in range(n_compute):
+        for frame in frames[:len(addr) // 4 + 1]:      # A quarter of the sensors send a new value each frame
+            manager.recv_frame(frame)
+        t = mtools.monotonic()
+        manager.compute_all()
+        duration += mtools.monotonic() - t
+        frames.append(frames.pop(0))
+    return duration / n_compute * 1e6
+
+
+def bench_dmx(addr, duration, rate):
+    """
+    Run the DMX and sensor threads together
+    :param rate: serial bytes per second received by the sensor thread
+    :return: dict of achieved fps and jitter in ms
+    """
+    xbee = wsn.Xbee(port=MemorySerial(make_stream(addr, 1000), rate), capture_path="")
+    dmx = dict(settings.settings.get("dmx"))
+    dmx["suppress"] = False                         # Send every tick to measure the cadence
+    settings.settings["dmx"] = dmx
+    settings.settings.compile()
+    dmx_th = light.DmxThread()
+    sensor_th = wsn.SensorThread(xbee, dmx_th.dmxout)
+    dmx_th.set_compute_all(sensor_th.sensors.compute_all)
+    sensor_th.start()
+    dmx_th.start()
+    time.sleep(duration)
+    dmx_th.close()
+    sensor_th.close()
+    dmx_th.join()
+    sensor_th.join()
+    client = dmx_th.backend.client      # Connected by the thread
+    stamps = np.array([t for t, universe in client.sent[1:-1]])    # Ignore the clean up frames
+    if len(stamps) < 2:
+        return {"fps": 0, "jitter_ms": None, "max_late_ms": None}
+    intervals = np.diff(stamps)
+    return {
+        "fps": (len(stamps) - 1) / (stamps[-1] - stamps[0]),
+        "jitter_ms": float(np.std(intervals)) * 1e3,
+        "max_late_ms": float(np.max(intervals) - dmx_th.dt) * 1e3,
+        "scheduler": dmx_th.scheduler.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WSN light pipeline")
+    parser.add_argument("--sensors", default="8,64,256", help="comma separated numbers of sensors")
+    parser.add_argument("--depth", default="1", help="comma separated sensor depths in seconds")
+    parser.add_argument("--frames", type=int, default=20000, help="frames used by the ingest benchmarks")
+    parser.add_argument("--compute", type=int, default=500, help="compute_all calls per measure")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of DMX run per measure")
+    parser.add_argument("--rate", type=float, default=960, help="serial bytes/s during the DMX run")
+    parser.add_argument("--output", default=None, help="JSON file, stdout if not given")
+    args = parser.parse_args()
+
+    results = {
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "fps": settings.settings.get("dmx", "fps"),
+        "runs": [],
+    }
+    for n_sensors in [int(n) for n in args.sensors.split(",")]:
+        for depth in [float(d) for d in args.depth.split(",")]:
+            addr = configure(n_sensors, depth)
+            results["runs"].append({
+                "sensors": n_sensors,
+                "depth": depth,
+                "parse_frames_per_s": bench_parse(addr, args.frames),
+                "recv_frames_per_s": bench_recv(addr, args.frames),
+                "compute_all_us": bench_compute(addr, args.compute),
+                "dmx": bench_dmx(addr, args.duration, args.rate),
+            })
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print("")
+    else:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+settings.init("")
+logger.SETTINGS = settings.settings
+settings.settings["log"] = {"level": "warning", "output": "Console"}
+install_fake_ola()
+
+from code.lib import mtools
+from code.lib import wsn
+from code.lib import light
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,256 @@
 #!/bin/python2
 # -*- coding: utf-8 -*-
 
+import fcntl
+import multiprocessing
+import os
+import signal
+import socket
+import sys
 import time
 
+import numpy as np
+
 from lib import settings
 settings.init()
 
 from lib import wsn
 from lib import light
 from lib import logger
+from lib import metrics
+from lib import mtools
 
 
 settings = settings.settings
 logger.SETTINGS = settings
 log = logger.init_log("main", settings)
-dt = 1 / float(settings.get("dmx", "fps"))
 
-if __name__ == "__main__":
+LOCK_PATH = "/tmp/wsnlight.lock"      # Held while running, hold it to keep wsnlight from starting (ex: for test)
+RESTART_DELAY = 0.5                   # Seconds between two checks of the processes
+
+LOCK = None             # Open file holding LOCK_PATH, only the supervisor keeps it
+SUPERVISOR_PID = None   # Process running supervise, the children inherit its signal handlers until init_child
+
+
+def make_xbees():
+    """
+    :return: (list of Xbee, True if they are replayed from a capture)
+    """
+    port = None
+    if settings.get("xbee", "replay") != "":
+        port = wsn.ReplaySerial(settings.get("xbee", "replay"), settings.get("xbee", "replay_speed"))
+    return wsn.make_xbees(port), port is not None
+
+
+def make_sensor_threads(xbees, dmxout, wake, sensors=None):
+    """
+    Create a SensorThread for each Xbee, they all feed the same sensors through their own SensorInput
+    :param sensors: SensorManager, None to create it, its inputs are used in order then created
+    :return: list of SensorThread
+    """
+    threads = []
+    for i in range(len(xbees)):
+        sensor_input = sensors.inputs[i] if sensors is not None and i < len(sensors.inputs) else None
+        threads.append(wsn.SensorThread(xbees[i], dmxout, wake, sensors, sensor_input))
+        sensors = threads[0].sensors
+    return threads
+
+
+def start_metrics(sources, offset=0):
+    """
+    Start the metrics exporter if enabled, the lights don't depend on it : a port already used is only logged
+    :param sources: objects with a metrics() method
+    :param offset: added to the port of the settings
+    :return:
+    """
+    if settings.get("metrics", "port") == 0:
+        return
+    host, port = str(settings.get("metrics", "host")), int(settings.get("metrics", "port")) + offset
     try:
-        xbee = wsn.Xbee()
+        metrics.MetricsExporter(sources, host, port).start()
+    except socket.error as e:
+        log.warning("Can't export metrics on {0}:{1}, continue without : {2}", host, port, e)
+
+
+def watch_settings(alive):
+    """
+    Reload the settings file when it is modified, until alive returns False
+    :param alive: function
+    :return:
+    """
+    last_check = time.time()
+    while alive():
+        time.sleep(0.05)
+        if time.time() - last_check > 1:
+            last_check = time.time()
+            if settings.modified():
+                settings.reload()
+
+
+def run_threads():
+    """
+    Run the ingest and the output as threads of this process
+    :return:
+    """
+    sensor_ths = []
+    dmx_th = None
+    try:
+        xbees, replayed = make_xbees()
         dmx_th = light.DmxThread()
-        sensor_th = wsn.SensorThread(xbee, dmx_th.dmxout)
-        dmx_th.set_compute_all(sensor_th.sensors.compute_all)
-        #sensors = wsn.SensorManager(tuple(settings.get("sensor", "addr")), dmx.dmxout)
-        if xbee.init():
-            sensor_th.start()
+        sensor_ths = make_sensor_threads(xbees, dmx_th.dmxout, dmx_th.wake if dmx_th.event else None)
+        sensors = sensor_ths[0].sensors
+        dmx_th.set_compute_all(sensors.compute_all)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dmx_th.telemetry.dump(settings.get("telemetry", "path")))
+        signal.signal(signal.SIGHUP, lambda signum, frame: settings.reload())
+        start_metrics(xbees + sensor_ths + [sensors, dmx_th])
+        if replayed or all([xbee.init() for xbee in xbees]):   # A replayed radio doesn't need to be configured
+            for sensor_th in sensor_ths:        # Ingest while the DMX output comes up
+                sensor_th.start()
             dmx_th.start()
-            while True:
-                time.sleep(0.05)
+            watch_settings(lambda: True)
+        else:
+            log.error("Can't init Xbee")
+    except KeyboardInterrupt as e:
+        print(str(e))
+    finally:
+        for sensor_th in sensor_ths:
+            sensor_th.close()
+        if dmx_th is not None:
+            dmx_th.close()
+
+
+def init_child():
+    """
+    First call of the processes started by supervise : replace the signal handlers inherited from it, release its
+    lock and exit with it
+    :return:
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGHUP, lambda signum, frame: settings.reload())
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)      # The output sets it again for the telemetry dump
+    mtools.set_parent_death_signal(signal.SIGTERM)
+    if os.getppid() != SUPERVISOR_PID:                  # Exited before the death signal was set
+        sys.exit(0)
+    if LOCK is not None:
+        LOCK.close()        # A new instance waits for the lock, not for orphans of this one
+
+
+def run_ingest(handoffs, commands, wake_w):
+    """
+    Ingest process : read the Xbees and push the values in the shared rings
+    :param handoffs: SharedSpscRing of the values of each Xbee
+    :param commands: SharedSpscRing of the over the air commands of each Xbee
+    :param wake_w: write end of the wake pipe of the output process
+    :return:
+    """
+    init_child()
+    sensor_ths = []
+    try:
+        xbees, replayed = make_xbees()
+        universes = len(settings.get("dmx", "universes"))
+        sensors = wsn.SensorManager(settings.snapshot.addr, np.zeros(universes * light.UNIVERSE_SIZE, dtype=np.uint8),
+                                    handoffs[:len(xbees)], commands[:len(xbees)])   # Only its inputs are used
+        wake = None
+        if settings.snapshot.mode == "event":
+            wake = lambda: light.wake_pipe(wake_w)
+        sensor_ths = make_sensor_threads(xbees, sensors.dmx_output, wake, sensors)
+        start_metrics(xbees + sensor_ths, offset=1)
+        if replayed or all([xbee.init() for xbee in xbees]):
+            for sensor_th in sensor_ths:
+                sensor_th.start()
+            watch_settings(lambda: all([sensor_th.is_alive() for sensor_th in sensor_ths]))
         else:
             log.error("Can't init Xbee")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for sensor_th in sensor_ths:
+            sensor_th.close()
+        logger.flush()      # The process exit with os._exit, without the atexit handlers
+
+
+def run_output(handoffs, commands, wake_fds):
+    """
+    Output process : compute the values of the shared rings and send them
+    :param handoffs: SharedSpscRing of the values of each Xbee
+    :param commands: SharedSpscRing of the over the air commands of each Xbee
+    :param wake_fds: wake pipe of light.make_wake_pipe
+    :return:
+    """
+    init_child()
+    dmx_th = None
+    try:
+        dmx_th = light.DmxThread(wake_fds=wake_fds)
+        sensors = wsn.SensorManager(settings.snapshot.addr, dmx_th.dmxout, handoffs, commands)
+        dmx_th.set_compute_all(sensors.compute_all)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dmx_th.telemetry.dump(settings.get("telemetry", "path")))
+        start_metrics([sensors, dmx_th])
+        dmx_th.start()
+        watch_settings(dmx_th.is_alive)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if dmx_th is not None:
+            dmx_th.close()
+            dmx_th.join()
+        logger.flush()
+
+
+def supervise():
+    """
+    Run the ingest and the output in two processes sharing the rings, restart the one which exit
+    :return:
+    """
+    n_xbees = max(len(settings.get("xbee", "coordinators")), 1)
+    handoffs = [mtools.SharedSpscRing(settings.snapshot.handoff_size) for i in range(n_xbees)]
+    commands = [mtools.SharedSpscRing(wsn.COMMAND_RING_SIZE) for i in range(n_xbees)]
+    wake_fds = light.make_wake_pipe()
+    targets = {
+        "ingest": (run_ingest, (handoffs, commands, wake_fds[1])),
+        "output": (run_output, (handoffs, commands, wake_fds)),
+    }
+    processes = dict()
+    global SUPERVISOR_PID
+    SUPERVISOR_PID = os.getpid()
+
+    def forward(signum, frame):     # Reload and telemetry dump are done by the processes
+        if os.getpid() != SUPERVISOR_PID:       # Child which hasn't run init_child yet
+            return
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))    # Stop the children in finally
+    try:
+        while True:
+            for name, (target, args) in targets.items():
+                process = processes.get(name)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    log.error("{0} process exited with {1}, restart it", name, process.exitcode)
+                processes[name] = multiprocessing.Process(target=target, args=args, name=name)
+                processes[name].start()
+            time.sleep(RESTART_DELAY)
     except KeyboardInterrupt as e:
         print(str(e))
     finally:
-        sensor_th.close()
-        dmx_th.close()
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join()
+
 
+if __name__ == "__main__":
+    LOCK = open(LOCK_PATH, "a")
+    try:
+        fcntl.flock(LOCK, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        log.info("Wait for {0}", LOCK_PATH)
+        fcntl.flock(LOCK, fcntl.LOCK_EX)
+    if settings.get("multiprocess"):
+        supervise()
+    else:
+        run_threads()